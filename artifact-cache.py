@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Restore unchanged projects from snapshots instead of rebuilding them.
+
+After a fresh checkout or a purge, projects whose sources match an
+earlier build are restored from a snapshot (a tar of the build directory
+and the InstallArea) kept in artifactCachePath. The key of a snapshot is
+made of the git tree of the project, BINARY_TAG, the toolchain and
+configuration, the absolute paths (which end up in the build files) and
+the keys of the upstream projects. Uncommitted changes are part of the
+key through `git diff HEAD` and the size and time of untracked files.
+
+The keys are kept in outputPath/artifact-keys and reused within one
+top-level make (LBSTACK_INVOCATION), such that the upstream projects are
+not checked again for every project. Snapshots are written by a detached
+process in the background.
+
+Usage (see make.sh):
+
+    key=$(artifact-cache.py key Project)
+    artifact-cache.py restore Project $key || { build && \\
+        artifact-cache.py save Project $key; }
+
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+from config import read_config, DIR
+from utils import (
+    setup_logging,
+    topo_sorted,
+    read_make_config,
+    project_dependencies,
+)
+
+config = None
+log = None
+
+
+def git(project, *args):
+    return subprocess.run(['git'] + list(args),
+                          cwd=os.path.join(config['projectPath'], project),
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL,
+                          check=True).stdout
+
+
+def local_changes(project):
+    """Return a digest of the uncommitted changes of a project."""
+    h = hashlib.sha1(git(project, 'diff', 'HEAD', '--binary'))
+    untracked = git(project, 'ls-files', '--others', '--exclude-standard',
+                    '-z').split(b'\0')
+    for name in filter(None, untracked):
+        try:
+            st = os.stat(
+                os.path.join(config['projectPath'], project, os.fsdecode(name)))
+        except FileNotFoundError:
+            continue
+        h.update(name + f' {st.st_size} {st.st_mtime_ns}\0'.encode())
+    return h.hexdigest().encode()
+
+
+def project_key(project, binary_tag, upstream_keys):
+    """Return the key of a project, or None if it is not a git repository."""
+    try:
+        tree = git(project, 'rev-parse', 'HEAD^{tree}').strip()
+        changes = local_changes(project)
+    except subprocess.CalledProcessError:
+        return None
+    cmake_flags = config['cmakeFlags']
+    with open(os.path.join(DIR, 'toolchain.cmake'), 'rb') as f:
+        toolchain = f.read()
+    h = hashlib.sha1()
+    for part in [
+            project.encode(),
+            tree,
+            changes,
+            binary_tag.encode(),
+            str(config['lcgVersion']).encode(),
+            toolchain,
+            cmake_flags.get('default', '').encode(),
+            cmake_flags.get(project, '').encode(),
+            os.environ.get('CMAKEFLAGS', '').encode(),
+            config['projectPath'].encode(),
+            config['buildPath'].encode(),
+    ] + upstream_keys:
+        h.update(part + b'\0')
+    return h.hexdigest()
+
+
+def key_path(project, binary_tag):
+    return os.path.join(config['outputPath'], 'artifact-keys', binary_tag,
+                        project)
+
+
+def stored_key(project, binary_tag):
+    """Return the key stored in this invocation as (key,), or None."""
+    invocation = os.environ.get('LBSTACK_INVOCATION')
+    try:
+        with open(key_path(project, binary_tag)) as f:
+            stored_invocation, _, key = f.read().partition(' ')
+    except FileNotFoundError:
+        return None
+    if not invocation or stored_invocation != invocation:
+        return None
+    return (key or None, )
+
+
+def store_key(project, binary_tag, key):
+    invocation = os.environ.get('LBSTACK_INVOCATION')
+    if not invocation:
+        return
+    path = key_path(project, binary_tag)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        f.write(f'{invocation} {key or ""}')
+    os.replace(tmp, path)
+
+
+def compute_key(project, binary_tag):
+    variables = read_make_config(
+        os.path.join(config['outputPath'], f'configuration-{binary_tag}.mk'))
+    deps = project_dependencies(variables)
+    keys = {}
+    for p in topo_sorted(deps, [project]):
+        stored = stored_key(p, binary_tag) if p != project else None
+        if stored:
+            keys[p], = stored
+            continue
+        upstream = [keys[d] for d in sorted(deps.get(p, []))]
+        if None in upstream:
+            keys[p] = None
+        else:
+            keys[p] = project_key(p, binary_tag, [k.encode() for k in upstream])
+        store_key(p, binary_tag, keys[p])
+    return keys[project]
+
+
+def snapshot_path(project, key):
+    return os.path.join(config['artifactCachePath'], project, f'{key}.tar')
+
+
+def snapshot_dirs(binary_tag):
+    return [f'build.{binary_tag}', os.path.join('InstallArea', binary_tag)]
+
+
+def touch_all(paths, timestamp):
+    """Give all files the same time, newer than the sources."""
+    for top in paths:
+        for dirpath, dirs, files in os.walk(top):
+            for name in dirs + files:
+                os.utime(
+                    os.path.join(dirpath, name), (timestamp, timestamp),
+                    follow_symlinks=False)
+
+
+def restore(project, key, binary_tag):
+    """Restore a snapshot if there is no build yet. Return True if done."""
+    project_build = os.path.join(config['buildPath'], project)
+    if os.path.exists(
+            os.path.join(project_build, f'build.{binary_tag}', 'build.ninja')):
+        return False
+    path = snapshot_path(project, key)
+    if not os.path.exists(path):
+        return False
+    log.info(f"Restoring {project} from {path}")
+    try:
+        subprocess.run(['tar', '-xf', path, '-C', project_build], check=True)
+    except subprocess.CalledProcessError:
+        log.warning(f"Failed to restore {path}")
+        return False
+    # The sources may be newer than the snapshot, which would make
+    # ninja rebuild everything.
+    touch_all(
+        [os.path.join(project_build, d) for d in snapshot_dirs(binary_tag)],
+        time.time())
+    return True
+
+
+def start_saver(project, key, binary_tag):
+    """Save a snapshot in a detached process, not to delay the build."""
+    if os.path.exists(snapshot_path(project, key)):
+        return
+    cmd = ['nice', '-n', '19']
+    if shutil.which('ionice'):
+        cmd += ['ionice', '-c', '3']
+    cmd += [os.path.abspath(__file__), 'save-now', project, key]
+    subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+def save(project, key, binary_tag):
+    path = snapshot_path(project, key)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    log.info(f"Saving {project} to {path}")
+    # a new build during the save would give an inconsistent snapshot
+    ninja_log = os.path.join(config['buildPath'], project,
+                             f'build.{binary_tag}', '.ninja_log')
+
+    def build_stamp():
+        try:
+            return os.stat(ninja_log).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    stamp = build_stamp()
+    tmp = f'{path}.{os.getpid()}'
+    try:
+        subprocess.run(
+            ['tar', '-cf', tmp, '-C',
+             os.path.join(config['buildPath'], project)] +
+            snapshot_dirs(binary_tag),
+            check=True)
+        if build_stamp() != stamp:
+            log.info(f"{project} was rebuilt while saving, not saved")
+            return
+        os.replace(tmp, path)
+    except subprocess.CalledProcessError:
+        log.warning(f"Failed to save {path}")
+        return
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    # keep only the most recent snapshots of each project
+    snapshots = sorted((os.path.join(os.path.dirname(path), name)
+                        for name in os.listdir(os.path.dirname(path))
+                        if name.endswith('.tar')),
+                       key=os.path.getmtime)
+    for old in snapshots[:-config['artifactCacheKeep']]:
+        os.remove(old)
+
+
+def main(args):
+    global config, log
+    if not (args[:1] == ['key'] and len(args) == 2 or
+            args[:1] in [['restore'], ['save'], ['save-now']]
+            and len(args) == 3):
+        exit(f"usage: {os.path.basename(__file__)} "
+             "key Project | restore|save Project KEY")
+    command, project = args[:2]
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    binary_tag = os.environ['BINARY_TAG']
+    if not config['artifactCachePath']:
+        return 1
+    if command == 'key':
+        key = compute_key(project, binary_tag)
+        if key:
+            print(key)
+        return 0
+    elif command == 'restore':
+        return 0 if restore(project, args[2], binary_tag) else 1
+    elif command == 'save':
+        start_saver(project, args[2], binary_tag)
+        return 0
+    elif command == 'save-now':
+        save(project, args[2], binary_tag)
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
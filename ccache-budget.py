@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Keep all ccache directories on this machine within one disk budget.
+
+Each platform (and each stack not sharing ccachePath) has its own cache,
+created without a size limit. This script looks at the caches matching
+ccachePath (with $BINARY_TAG as a wildcard) and ccacheBudgetPaths, and
+evicts the least recently used entries across all of them until their
+total size is below ccacheBudget (in GB). Entries of caches with a high
+hit rate age more slowly, so that a cold cache (e.g. of an old platform)
+is evicted first.
+
+It also reports the value of each cache as hits per GB.
+
+Usage: ccache-budget.py [--dry-run] [--if-due]
+
+"""
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+from config import read_config
+from utils import setup_logging, is_file_too_old
+
+GB = 1024**3
+# Files in a cache directory that are not cache entries
+NOT_ENTRIES = {'stats', 'CACHEDIR.TAG', 'ccache.conf'}
+# With --if-due, run at most once in this time
+PERIOD = 24 * 3600  # seconds
+
+config = None
+log = None
+
+
+def cache_dirs():
+    patterns = [config['ccachePath'].replace('$BINARY_TAG', '*')]
+    patterns += config['ccacheBudgetPaths']
+    dirs = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.expanduser(pattern)):
+            if os.path.isfile(os.path.join(path, 'CACHEDIR.TAG')) or \
+                    os.path.isdir(os.path.join(path, '0')):
+                dirs.add(os.path.realpath(path))
+    return sorted(dirs)
+
+
+def entries(cache_dir):
+    """Yield (last use, size, path) of all entries in a cache.
+
+    The last use is the later of the access and modification times, as
+    ccache touches the entries it hits.
+
+    """
+    stack = [cache_dir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ['tmp', 'lock']:
+                        stack.append(entry.path)
+                elif entry.name not in NOT_ENTRIES:
+                    st = entry.stat(follow_symlinks=False)
+                    yield (max(st.st_atime, st.st_mtime), st.st_size,
+                           entry.path)
+
+
+def ccache():
+    return os.path.join(config['contribPath'], 'bin', 'ccache')
+
+
+def hit_stats(cache_dir):
+    """Return (hits, misses) from the cache statistics."""
+    result = subprocess.run([ccache(), '--print-stats'],
+                            env=dict(os.environ, CCACHE_DIR=cache_dir),
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    stats = {}
+    for line in result.stdout.splitlines():
+        name, _, value = line.partition('\t')
+        if value.isdigit():
+            stats[name] = int(value)
+    hits = stats.get('direct_cache_hit', 0) + stats.get(
+        'preprocessed_cache_hit', 0)
+    return hits, stats.get('cache_miss', 0)
+
+
+def evict(caches, budget, dry_run):
+    """Delete entries across caches until their total size fits budget.
+
+    The age of an entry is divided by (0.5 + hit rate of its cache).
+
+    """
+    now = time.time()
+    total = sum(cache['size'] for cache in caches)
+    if total <= budget:
+        return total
+    candidates = []
+    for cache in caches:
+        weight = 0.5 + cache['hit_rate']
+        for used, size, path in cache['entries']:
+            candidates.append(((now - used) / weight, size, path, cache))
+    candidates.sort(reverse=True)
+    for _, size, path, cache in candidates:
+        if total <= budget:
+            break
+        if not dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        cache['evicted'] += size
+        total -= size
+    return total
+
+
+def main():
+    global config, log
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Only report what would be evicted')
+    parser.add_argument(
+        '--if-due',
+        action='store_true',
+        help='Do nothing if the last run was recent')
+    args = parser.parse_args()
+
+    # keep $BINARY_TAG in ccachePath to find the caches of all platforms
+    os.environ.pop('BINARY_TAG', None)
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    timestamp = os.path.join(config['outputPath'], 'ccache-budget.timestamp')
+    if args.if_due and (not config['ccacheBudget']
+                        or not is_file_too_old(timestamp, PERIOD)):
+        return 0
+    with open(timestamp, 'w'):
+        pass
+
+    caches = []
+    for path in cache_dirs():
+        hits, misses = hit_stats(path)
+        # scan each cache once, the entries are reused for the eviction
+        cache_entries = list(entries(path))
+        caches.append({
+            'path': path,
+            'hits': hits,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0,
+            'entries': cache_entries,
+            'size': sum(size for _, size, _ in cache_entries),
+            'evicted': 0,
+        })
+    if not caches:
+        log.info("No ccache directories found")
+        return 0
+
+    budget = config['ccacheBudget'] * GB
+    total = sum(c['size'] for c in caches)
+    if budget:
+        total = evict(caches, budget, args.dry_run)
+    for cache in caches:
+        if cache['evicted'] and not args.dry_run:
+            # let ccache recompute its size counters
+            subprocess.run([ccache(), '-c'],
+                           env=dict(os.environ, CCACHE_DIR=cache['path']),
+                           stdout=subprocess.DEVNULL)
+        size = cache['size'] / GB
+        print(f"{cache['path']}: {size:.1f} GB, "
+              f"hit rate {cache['hit_rate']:.0%}, "
+              f"{cache['hits'] / size if size else 0:.0f} hits/GB, "
+              f"{'would evict' if args.dry_run else 'evicted'} "
+              f"{cache['evicted'] / GB:.1f} GB")
+    print(f"Total: {total / GB:.1f} GB of "
+          f"{f'{budget / GB:.0f} GB' if budget else 'unlimited'}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Pull the cache entries of the objects to be rebuilt before the build.
+
+With a remote ccache storage (ccacheHosts), every local miss is followed
+by a synchronous remote lookup in the middle of the compilation. This
+script takes the compilations that ninja plans to run and runs ccache on
+each of them up front, many in parallel, with a fake compiler of the same
+name that always fails. A hit (local or remote) ends up in the local
+cache; a miss fails immediately without compiling. The outputs are
+written to a temporary directory, not to the build directory, and the
+lookups are not counted in the ccache statistics.
+
+Any storage supported by ccache works, e.g. a file:// storage instead of
+redis.
+
+Usage: ccache-prefetch.py BUILD_DIR
+
+"""
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import read_config, cpu_count
+from utils import setup_logging
+
+# Options whose argument is a file written by the compiler
+OUTPUT_OPTIONS = ['-o', '-MF']
+
+config = None
+log = None
+
+
+def planned_compilations(build_dir):
+    """Return the argument lists of the compilations ninja would run."""
+    ninja = os.path.join(config['contribPath'], 'bin', 'ninja')
+    result = subprocess.run([ninja, '-C', build_dir, '-n', '-v'],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    compilations = []
+    for line in result.stdout.splitlines():
+        # lines look like "[1/100] /path/to/compile.sh g++ ... -c src.cpp"
+        _, _, command = line.partition('] ')
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            continue
+        if args and os.path.basename(args[0]) == 'compile.sh':
+            compilations.append(args[1:])
+    return compilations
+
+
+def fake_compiler(fake_dir, compiler):
+    """Create a compiler with the same name as `compiler` that fails."""
+    path = os.path.join(fake_dir, os.path.basename(compiler))
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexit 1\n')
+    os.chmod(path, 0o755)
+
+
+def prefetch(args, index, fake_dir, env):
+    """Look up one compilation in the cache, return True on a hit."""
+    args = list(args)
+    args[0] = os.path.join(fake_dir, os.path.basename(args[0]))
+    for i, arg in enumerate(args[:-1]):
+        if arg in OUTPUT_OPTIONS:
+            args[i + 1] = os.path.join(fake_dir, f'{index}{arg}')
+    result = subprocess.run(['ccache'] + args,
+                            env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+def main(args):
+    global config, log
+    if len(args) != 1:
+        exit(f"usage: {os.path.basename(__file__)} BUILD_DIR")
+    build_dir, = args
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    if not os.path.exists(os.path.join(build_dir, 'build.ninja')):
+        return 0
+
+    start = time.time()
+    compilations = planned_compilations(build_dir)
+    if not compilations:
+        return 0
+    # do not compile (remotely) and do not count in the build statistics
+    # nor in the statistics of the cache (ccache -s)
+    env = dict(os.environ, CCACHE_NOSTATS='1')
+    for name in ['CCACHE_PREFIX', 'CCACHE_PREFIX_CPP', 'CCACHE_STATSLOG']:
+        env.pop(name, None)
+    fake_dir = tempfile.mkdtemp(prefix='ccache-prefetch-')
+    try:
+        for compiler in {args[0] for args in compilations}:
+            fake_compiler(fake_dir, compiler)
+        os.chdir(build_dir)
+        with ThreadPoolExecutor(max_workers=min(32, 4 * cpu_count())) as ex:
+            hits = sum(
+                ex.map(lambda x: prefetch(x[1], x[0], fake_dir, env),
+                       enumerate(compilations)))
+    finally:
+        shutil.rmtree(fake_dir, ignore_errors=True)
+    log.info(f"Found {hits} of {len(compilations)} objects to build in "
+             f"ccache (prefetched in {time.time() - start:.1f}s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
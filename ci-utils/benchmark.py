@@ -0,0 +1,448 @@
+"""Benchmark the orchestration layer on a synthetic stack.
+
+A stack is generated in a temporary directory with
+- N projects (Proj00, Proj01, ...) with a random lhcbproject.yml
+  dependency DAG, and M data packages (DBASE/Data00, ...),
+- bare file:// remotes with a history of the given depth,
+- a copy of the utils directory (including uncommitted changes),
+- fake cmake, ninja, ctest and ccache in the lbenvPath given to it.
+
+The following are measured (best of --repeat runs, in seconds):
+- setup-make-cold: setup-make.py cloning everything,
+- setup-make-warm: setup-make.py with everything cloned,
+- check-staleness: check_staleness() fetching all repositories,
+- make-update: `make update` with a new commit in each remote,
+- make-report: `make report`,
+- vscode-settings: a forced update of the VSCode settings,
+- ninja-summary: post_build_ninja_summary.py on a synthetic .ninja_log.
+
+The times depend on the host, so a fixed reference workload (process
+spawns, git and python, see reference_time) is timed as well. The
+results are written as JSON and compared with the maximum times in
+benchmark-thresholds.json (for the default parameters) and optionally
+with the results of a previous run (--baseline), both scaled by the
+ratio of the reference times. The exit code is 1 if anything regressed.
+
+Usage: python3 utils/ci-utils/benchmark.py [--output results.json] ...
+
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+UTILS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+THRESHOLDS = os.path.join(os.path.dirname(__file__),
+                          'benchmark-thresholds.json')
+BINARY_TAG = 'x86_64_v2-el9-gcc13-opt'
+DEFAULTS = {
+    'projects': 12,
+    'data_packages': 4,
+    'history': 200,
+    'files': 200,
+    'ninja_entries': 50000,
+    'seed': 1,
+}
+FAKE_TOOL = '#!/bin/sh\necho "$(basename $0) (fake for benchmark.py)"\n'
+COMMITTER = 'Benchmark <benchmark@example.com>'
+
+
+def fast_import_stream(files, history, start, parent=None):
+    """Return a git fast-import stream of `history` commits.
+
+    The first commit adds `files` (unless a parent is given) and each
+    following commit modifies one of them.
+
+    """
+    names = sorted(files)
+    chunks = []
+    for i in range(history):
+        message = f'Commit {i}\n'
+        chunks.append(f'commit refs/heads/master\nmark :{i + 1}\n'
+                      f'committer {COMMITTER} {start + i} +0000\n'
+                      f'data {len(message)}\n{message}')
+        if i > 0:
+            chunks.append(f'from :{i}\n')
+        elif parent:
+            chunks.append(f'from {parent}\n')
+        if i == 0 and not parent:
+            changed = {n: files[n] for n in names}
+        else:
+            name = names[i % len(names)]
+            changed = {name: files[name] + f'// revision {start + i}\n'}
+        for name, content in changed.items():
+            data = content.encode()
+            chunks.append(f'M 644 inline {name}\ndata {len(data)}\n')
+            chunks.append(content + '\n')
+    return ''.join(chunks).encode()
+
+
+def create_remote(path, files, history):
+    subprocess.run(['git', 'init', '-q', '--bare', path], check=True)
+    subprocess.run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'],
+                   cwd=path,
+                   check=True)
+    subprocess.run(['git', 'fast-import', '--quiet'],
+                   cwd=path,
+                   input=fast_import_stream(files, history, 1600000000),
+                   check=True)
+
+
+def add_commit(path):
+    """Add a commit on top of master in a bare repository."""
+    stream = fast_import_stream({'NEWS': 'news\n'}, 1, int(time.time()),
+                                'refs/heads/master^0')
+    subprocess.run(['git', 'fast-import', '--quiet'],
+                   cwd=path,
+                   input=stream,
+                   check=True)
+
+
+def project_files(name, deps, n_files):
+    files = {
+        'CMakeLists.txt':
+        'cmake_minimum_required(VERSION 3.15)\n'
+        f'project({name} VERSION 1.0 LANGUAGES CXX)\n',
+        # LCG is ignored, so that there is always a dependency listed
+        'lhcbproject.yml':
+        'name: {}\nlicense: GPL-3.0-only\ndependencies:\n{}'.format(
+            name, ''.join(f'  - {d}\n' for d in ['LCG'] + deps)),
+    }
+    for i in range(n_files):
+        files[f'Pkg{i % 10}/src/File{i}.cpp'] = (
+            f'// {name} file {i}\nint f{i}() {{ return {i}; }}\n')
+    return files
+
+
+def generate_stack(root, args):
+    rng = random.Random(args.seed)
+    remotes = os.path.join(root, 'remotes')
+    projects = [f'Proj{i:02d}' for i in range(args.projects)]
+    deps = {}
+    for i, p in enumerate(projects):
+        deps[p] = sorted(rng.sample(projects[:i], min(i, rng.randint(1, 3))))
+        create_remote(
+            os.path.join(remotes, 'lhcb', p + '.git'),
+            project_files(p, deps[p], args.files), args.history)
+    data_packages = [f'DBASE/Data{i:02d}' for i in range(args.data_packages)]
+    for dp in data_packages:
+        name = dp.split('/')[1]
+        files = {
+            'cmt/requirements': f'package {name}\nversion v1r0\n',
+            'CMakeLists.txt': f'# {name}\n',
+        }
+        files.update({f'options/opts{i}.py': f'# {i}\n' for i in range(50)})
+        create_remote(
+            os.path.join(remotes, 'lhcb-datapkg', name + '.git'), files,
+            args.history)
+
+    # fake LbEnv tools
+    lbenv = os.path.join(root, 'lbenv')
+    os.makedirs(os.path.join(lbenv, 'bin'))
+    for tool in ['cmake', 'ctest', 'ninja', 'ccache', 'python']:
+        path = os.path.join(lbenv, 'bin', tool)
+        with open(path, 'w') as f:
+            f.write(FAKE_TOOL)
+        os.chmod(path, 0o755)
+
+    stack = os.path.join(root, 'stack')
+    utils = os.path.join(stack, 'utils')
+    tracked = subprocess.run(['git', 'ls-files', '-z'],
+                             cwd=UTILS,
+                             stdout=subprocess.PIPE,
+                             check=True).stdout.decode().split('\0')
+    for name in filter(None, tracked):
+        src = os.path.join(UTILS, name)
+        if os.path.isfile(src) and name != 'config.json':
+            os.makedirs(os.path.dirname(os.path.join(utils, name)),
+                        exist_ok=True)
+            shutil.copy2(src, os.path.join(utils, name))
+    os.symlink(os.path.join('utils', 'Makefile'),
+               os.path.join(stack, 'Makefile'))
+    # no need for LbDevTools (see vscode.create_clang_format)
+    open(os.path.join(stack, '.clang-format'), 'w').close()
+    leaves = set(projects).difference(*deps.values())
+    config = {
+        'binaryTag': BINARY_TAG,
+        'lcgVersion': '105a',
+        'promptedModelSlot': True,
+        'gitBase': 'file://' + remotes,
+        'defaultProjects': sorted(leaves),
+        'dataPackages': data_packages,
+        'lbenvPath': lbenv,
+        'useDocker': False,
+        'useDistcc': False,
+        'localPoolDepth': 2,
+        'distccLocalslots': 1,
+        'distccLocalslotsCpp': 2,
+        'ccacheHostsKey': 'NA',
+        'functorJitNJobs': 1,
+    }
+    with open(os.path.join(utils, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=4)
+    git = ['git', '-c', 'user.name=Benchmark', '-c',
+           'user.email=benchmark@example.com']
+    subprocess.run(['git', 'init', '-q'], cwd=utils, check=True)
+    subprocess.run(['git', 'add', '-A'], cwd=utils, check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'utils'], cwd=utils,
+                   check=True)
+    return stack, remotes
+
+
+def environment():
+    env = dict(os.environ)
+    for name in ['BINARY_TAG', 'MAKEFLAGS', 'MAKELEVEL', 'MFLAGS',
+                 'LBSTACK_INVOCATION']:
+        env.pop(name, None)
+    return env
+
+
+def timed(cmd, cwd):
+    """Return the time until cmd and its background processes are done.
+
+    Background processes started by cmd (e.g. the update of the VSCode
+    settings forked by setup-make.py) are waited for through the
+    standard error they inherit, so that they are part of the time of
+    cmd and do not run during the next measurement.
+
+    """
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd,
+                            cwd=cwd,
+                            env=environment(),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE)
+    reader = threading.Thread(target=proc.stderr.read)
+    reader.start()
+    returncode = proc.wait()
+    reader.join()
+    elapsed = time.perf_counter() - start
+    proc.stderr.close()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return elapsed
+
+
+def timed_python(code, cwd):
+    """Return the time reported by a python snippet run in the stack."""
+    prologue = ('import importlib, sys, time\n'
+                'sys.path.insert(0, "utils")\n'
+                'sm = importlib.import_module("setup-make")\n'
+                'from config import read_config\n'
+                'from utils import setup_logging\n'
+                'sm.config = read_config()\n'
+                'sm.log = setup_logging(sm.config["outputPath"], sm.config)\n'
+                'repos = sm.list_repos()\n'
+                'dp_repos = sm.list_repos(sm.DATA_PACKAGE_DIRS)\n'
+                'start = time.perf_counter()\n')
+    epilogue = '\nprint(time.perf_counter() - start)\n'
+    result = subprocess.run(['python3', '-c', prologue + code + epilogue],
+                            cwd=cwd,
+                            env=environment(),
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True,
+                            check=True)
+    return float(result.stdout.split()[-1])
+
+
+def reference_time(repeat):
+    """Return the best time of a fixed workload, to compare hosts.
+
+    The workload is made of what the orchestration layer spends its time
+    on: starting processes, running git and running python code.
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(10):
+            subprocess.run(['python3', '-c', 'pass'], check=True)
+            subprocess.run(['git', '--version'],
+                           stdout=subprocess.DEVNULL,
+                           check=True)
+        sum(i * i for i in range(10**6))
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def remove_fetch_heads(stack):
+    for dirpath, dirs, files in os.walk(stack):
+        if 'FETCH_HEAD' in files and dirpath.endswith('.git'):
+            os.remove(os.path.join(dirpath, 'FETCH_HEAD'))
+        dirs[:] = [d for d in dirs if d != 'objects']
+
+
+def write_ninja_log(path, entries, seed):
+    rng = random.Random(seed)
+    lines = ['# ninja log v5\n']
+    t = 0
+    for i in range(entries):
+        duration = rng.randint(10, 20000)
+        ext = rng.choice(['.o', '.o', '.o', '.so', '.stamp', '.confdb'])
+        lines.append(f'{t}\t{t + duration}\t0\tobj/File{i}{ext}\t'
+                     f'{rng.getrandbits(64):x}\n')
+        t += rng.randint(0, 50)
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def run_benchmarks(stack, remotes, args):
+    results = {}
+
+    def measure(name, func, prepare=None):
+        times = []
+        for _ in range(args.repeat):
+            if prepare:
+                prepare()
+            times.append(func())
+        results[name] = {'best': min(times), 'all': times}
+        print(f"{name:<20} {min(times):8.3f} s", flush=True)
+
+    def clean_stack():
+        for name in os.listdir(stack):
+            if name not in ['utils', 'Makefile', '.clang-format']:
+                path = os.path.join(stack, name)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(
+                    path)
+
+    setup_make = ['python3', 'utils/setup-make.py']
+    measure('setup-make-cold', lambda: timed(setup_make, stack), clean_stack)
+    measure('setup-make-warm', lambda: timed(setup_make, stack))
+    measure(
+        'check-staleness',
+        lambda: timed_python('sm.check_staleness(repos + dp_repos)', stack),
+        lambda: remove_fetch_heads(stack))
+
+    def new_commits():
+        for group in os.listdir(remotes):
+            for name in os.listdir(os.path.join(remotes, group)):
+                add_commit(os.path.join(remotes, group, name))
+
+    measure('make-update', lambda: timed(['make', 'update'], stack),
+            new_commits)
+    # make report shows the environment of the last build
+    output = os.path.join(stack, '.output')
+    for name in ['make.sh.env', 'project.mk.env']:
+        open(os.path.join(output, name), 'a').close()
+    measure('make-report', lambda: timed(['make', 'report'], stack))
+    measure(
+        'vscode-settings', lambda: timed_python(
+            'deps = sm.find_all_deps(repos)\n'
+            'sm.write_vscode_settings(repos, dp_repos, deps, sm.config, '
+            'force=True)', stack))
+
+    ninja_log = os.path.join(output, 'benchmark.ninja_log')
+    write_ninja_log(ninja_log, args.ninja_entries, args.seed)
+    measure(
+        'ninja-summary', lambda: timed([
+            'python3', 'utils/external/post_build_ninja_summary.py',
+            ninja_log
+        ], stack))
+    return results
+
+
+def regressions(results, limits, scale, what):
+    """Compare the results with limits measured at another reference time.
+
+    The limits are multiplied by `scale`, the ratio of the reference
+    time of this run to the one of the limits.
+
+    """
+    failed = []
+    for name, limit in sorted(limits.items()):
+        limit *= scale
+        if name in results and results[name]['best'] > limit:
+            failed.append(f"{name}: {results[name]['best']:.3f} s > "
+                          f"{limit:.3f} s ({what})")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--projects', type=int, default=DEFAULTS['projects'])
+    parser.add_argument(
+        '--data-packages', type=int, default=DEFAULTS['data_packages'])
+    parser.add_argument(
+        '--history',
+        type=int,
+        default=DEFAULTS['history'],
+        help='Number of commits in each repository')
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=DEFAULTS['files'],
+        help='Number of source files in each project')
+    parser.add_argument(
+        '--ninja-entries', type=int, default=DEFAULTS['ninja_entries'])
+    parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the results to this file')
+    parser.add_argument(
+        '--baseline', help='Results of a previous run to compare with')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Allowed slowdown with respect to the baseline (fraction)')
+    parser.add_argument(
+        '--keep', action='store_true', help='Keep the synthetic stack')
+    args = parser.parse_args()
+
+    parameters = {k: getattr(args, k) for k in DEFAULTS}
+    reference = reference_time(args.repeat)
+    print(f"{'reference':<20} {reference:8.3f} s", flush=True)
+    root = tempfile.mkdtemp(prefix='lb-stack-benchmark-')
+    try:
+        print(f"Generating a synthetic stack in {root}", flush=True)
+        stack, remotes = generate_stack(root, args)
+        results = run_benchmarks(stack, remotes, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'parameters': parameters,
+        'repeat': args.repeat,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'reference': reference,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+
+    failed = []
+    if parameters == DEFAULTS:
+        with open(THRESHOLDS) as f:
+            thresholds = json.load(f)
+        failed += regressions(results, thresholds['limits'],
+                              reference / thresholds['reference'],
+                              'threshold')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != parameters:
+            print("Not comparing with a baseline with other parameters")
+        else:
+            failed += regressions(
+                results, {
+                    name: r['best'] * (1 + args.tolerance)
+                    for name, r in baseline['results'].items()
+                }, reference / baseline.get('reference', reference), 'baseline')
+    for line in failed:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -49,14 +49,27 @@ then
     error 'Color output is not enabled'
 fi
 
-if ! grep 'pool local_pool' $rules_ninja
+if ! $CMAKE -LA -N $build | \
+    grep '^CMAKE_CXX_LINKER_LAUNCHER:' | grep "utils/job-launcher.sh;link"
+then
+    error 'Linker launcher is not job-launcher.sh'
+fi
+
+for pool in link_pool genreflex_pool; do
+    if ! grep -A1 "pool $pool" $rules_ninja
+    then
+        error "Job pool $pool not defined"
+    fi
+done
+
+if ! grep 'pool = link_pool' $build_ninja | sort -u
 then
-    error 'Job pool not defined'
+    error 'Link job pool not used'
 fi
 
-if ! grep 'pool = local_pool' $build_ninja | sort -u
+if ! grep 'command = .*utils/job-launcher.sh link ' $rules_ninja | sort -u
 then
-    error 'Job pool not used'
+    error 'Links are not run by job-launcher.sh'
 fi
 
 # Skip legacy (e.g. 2018) Gaudi versions that do not support GENREFLEX_JOB_POOL
@@ -65,7 +78,7 @@ if ( cd "$build/.."; git grep GENREFLEX_JOB_POOL ) ; then
     # find genreflex followed by a blank line and count pool use
     # based on https://askubuntu.com/questions/919449/awk-matching-empty-lines
     n_genreflex_pool=$(awk '/COMMAND = .*genreflex /{flag=1}/^$/{flag=0}flag' $build_ninja \
-                    | grep 'pool = local_pool' | wc -l)
+                    | grep 'pool = genreflex_pool' | wc -l)
     if [ "$n_genreflex" != "$n_genreflex_pool" ]
     then
         error 'genreflex does not use dedicated job pool'
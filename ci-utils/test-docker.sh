@@ -0,0 +1,74 @@
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+source "$DIR/framework.sh"
+
+# Check that docker containers are reused, using a fake docker that runs
+# the "containers" as local processes.
+
+fake=$(mktemp -d)
+trap 'kill $(cat $fake/*.pid 2>/dev/null) 2>/dev/null; rm -rf $fake; _report' EXIT
+cat > $fake/docker <<'EOF'
+#!/bin/bash
+dir=$(dirname $0)
+echo "$@" >> $dir/calls
+cmd=$1; shift
+case $cmd in
+    --version) echo "Docker version 0.0 (fake)";;
+    run)
+        # run the command after the image, without the entrypoint
+        while [[ "$1" != --entrypoint=* ]]; do
+            [ "$1" = --name ] && name=$2
+            shift
+        done
+        shift 2
+        echo $$ > $dir/$name.pid
+        exec "$@";;
+    inspect) [ -f $dir/${@: -1}.pid ] && echo true;;
+    rm) kill $(cat $dir/${@: -1}.pid 2>/dev/null) 2>/dev/null; rm -f $dir/${@: -1}.pid;;
+    exec)
+        while [[ "$1" == -* ]]; do
+            case $1 in
+                -i|-t) shift; continue;;
+                -e) export "$2";;
+                -w) cd "$2";;
+            esac
+            shift 2
+        done
+        shift 2  # container name and entrypoint
+        "$@";;
+esac
+EOF
+chmod +x $fake/docker
+export PATH=$fake:$PATH
+container=utils/docker-container.py
+args=(--no-cvmfs --no-lbenv -C "$(pwd)" --use-absolute-path -- true)
+
+if ! { $container "${args[@]}" && $container "${args[@]}"; }
+then
+    error 'Running in a reused container failed'
+fi
+if [ "$(grep -c '^run ' $fake/calls)" != 1 ]
+then
+    error 'Container was not reused'
+fi
+if [ "$(grep -c '^exec ' $fake/calls)" != 2 ]
+then
+    error 'Commands were not run with docker exec'
+fi
+if [ "$($container --exec-env FOO=bar "${args[@]:0:5}" -- printenv FOO)" != bar ]
+then
+    error 'Variables are not passed to the command'
+fi
+if ! $container "${args[@]:0:5}" -- false
+then
+    :
+else
+    error 'Exit code of the command is not returned'
+fi
+
+# a container that is not running is replaced
+docker rm -f $(ls $fake/*.pid | xargs -n1 basename | sed 's/.pid$//')
+if ! $container "${args[@]}" || [ "$(grep -c '^run ' $fake/calls)" != 2 ]
+then
+    error 'Stopped container was not replaced'
+fi
+$container stop
@@ -0,0 +1,45 @@
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+source "$DIR/framework.sh"
+
+# Check that ccache-prefetch.py pulls the objects that ninja would build
+# from a remote (file://) storage into the local cache, without counting
+# the lookups in the ccache statistics.
+
+tmp=$(mktemp -d)
+trap 'rm -rf $tmp; _report' EXIT
+export PATH="$(pwd)/contrib/bin:$PATH"
+mkdir $tmp/src $tmp/build
+echo 'int f() { return 42; }' > $tmp/src/f.cpp
+cat > $tmp/build/build.ninja <<EOF
+rule cxx
+  command = $DIR/../compile.sh g++ -MD -MF \$out.d -c \$in -o \$out
+build f.o: cxx $tmp/src/f.cpp
+EOF
+
+# the same settings as make.sh
+export CCACHE_COMPILERCHECK=none CCACHE_DEPEND=1 CCACHE_BASEDIR=$tmp
+export CCACHE_SECONDARY_STORAGE="file://$tmp/remote"
+export COMPILER_PREFIX=ccache
+
+# fill the remote storage from another local cache
+CCACHE_DIR=$tmp/other ninja -C $tmp/build
+rm $tmp/build/f.o*
+
+export CCACHE_DIR=$tmp/local
+$DIR/../ccache-prefetch.py $tmp/build
+if [ -e $tmp/build/f.o ]
+then
+    error 'Prefetching wrote to the build directory'
+fi
+if ccache --print-stats | grep -E '^(direct|preprocessed)_cache_(hit|miss)\s+[1-9]'
+then
+    error 'Prefetching was counted in the ccache statistics'
+fi
+
+# the build finds the object in the local cache
+unset CCACHE_SECONDARY_STORAGE
+ninja -C $tmp/build
+if ! ccache --print-stats | grep -E '^direct_cache_hit\s+1$'
+then
+    error 'Prefetched object was not found in the local cache'
+fi
@@ -0,0 +1,121 @@
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+source "$DIR/framework.sh"
+
+# Check the supervision of distcc tunnels (tunnels.py), using a local TCP
+# forwarder instead of ssh and a fake distccd answering the handshake.
+# The scripts run from a copy of utils with their own config and output.
+
+fake=$(mktemp -d)
+trap 'kill $(cat $fake/*.pid 2>/dev/null) 2>/dev/null; rm -rf $fake; _report' EXIT
+mkdir $fake/utils
+cp "$DIR"/../*.py "$DIR"/../default-config.json $fake/utils/
+python3 - "$DIR/../config.json" $fake <<'EOF'
+import json, sys
+try:
+    config = json.load(open(sys.argv[1]))
+except FileNotFoundError:
+    config = {}
+config.update(outputPath=sys.argv[2] + '/output', distccTunnelIdleTimeout=30)
+json.dump(config, open(sys.argv[2] + '/utils/config.json', 'w'))
+EOF
+
+# a distccd that only answers the handshake
+cat > $fake/distccd.py <<'EOF'
+import socket, sys, threading
+server = socket.create_server(('127.0.0.1', 0))
+print(server.getsockname()[1], flush=True)
+def answer(conn):
+    with conn:
+        if conn.recv(1) == b'*':
+            conn.sendall(b'*')
+while True:
+    threading.Thread(target=answer, args=(server.accept()[0],)).start()
+EOF
+# forwards local ports like `ssh -N -L local:host:port ...`
+cat > $fake/forward.py <<'EOF'
+import socket, sys, threading
+def pipe(src, dst):
+    try:
+        while True:
+            data = src.recv(65536)
+            if not data:
+                break
+            dst.sendall(data)
+    except OSError:
+        pass
+    finally:
+        dst.close()
+def serve(server, host, port):
+    while True:
+        conn = server.accept()[0]
+        remote = socket.create_connection((host, int(port)))
+        threading.Thread(target=pipe, args=(conn, remote)).start()
+        threading.Thread(target=pipe, args=(remote, conn)).start()
+args = sys.argv[1:]
+for option, forward in zip(args[::2], args[1::2]):
+    local, host, port = forward.split(':')
+    server = socket.create_server(('127.0.0.1', int(local)))
+    threading.Thread(target=serve, args=(server, host, port)).start()
+EOF
+
+python3 -u $fake/distccd.py > $fake/distccd.port &
+echo $! > $fake/distccd.pid
+sleep 1
+remote_port=$(cat $fake/distccd.port)
+local_port=$(python3 -c 'import socket; s = socket.socket(); s.bind(("127.0.0.1", 0)); print(s.getsockname()[1])')
+export LBSTACK_TUNNEL_COMMAND="python3 $fake/forward.py"
+
+ensure() {
+    ( cd $fake/utils && python3 -c "
+import tunnels
+from config import read_config
+print(tunnels.ensure(read_config(), 'gateway', 'user',
+                     [($local_port, '127.0.0.1', $remote_port)]))" )
+}
+state() {
+    python3 -c "import json; print(json.load(open('$fake/output/tunnels/gateway.json')).get('$1'))"
+}
+
+# start
+if [ "$(ensure)" != "[$local_port]" ]
+then
+    error 'Tunnel was not started'
+fi
+supervisor=$(state pid)
+sleep 6  # let the supervisor record the forwarder
+
+# reuse
+if [ "$(ensure)" != "[$local_port]" -o "$(state pid)" != "$supervisor" ]
+then
+    error 'Running tunnel was not reused'
+fi
+
+# restart after the forwarder is killed
+kill $(state sshPid)
+for i in $(seq 25); do
+    sleep 1
+    [ "$(state restarts)" -gt 0 ] 2>/dev/null && ensure | grep -q $local_port && break
+done
+if [ "$(state restarts)" != 1 ] || ! ensure | grep -q $local_port
+then
+    error 'Tunnel was not restarted after the forwarder died'
+fi
+if [ "$(cd $fake/utils && ./tunnels.py status | grep -c OK)" != 1 ]
+then
+    error 'Status does not show a healthy forward'
+fi
+
+# exit when idle
+for i in $(seq 40); do
+    sleep 1
+    kill -0 $supervisor 2>/dev/null || break
+done
+if kill -0 $supervisor 2>/dev/null
+then
+    error 'Idle tunnel did not exit'
+    kill $supervisor
+fi
+if [ -f $fake/output/tunnels/gateway.json ]
+then
+    error 'State of the idle tunnel was not removed'
+fi
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Decide where to compile each translation unit from its past cost.
+
+Sending cheap translation units to distcc costs more in round-trips than
+compiling them locally. After a build, this script takes the duration of
+every compilation from .ninja_log and its outcome from the ccache stats
+log, and keeps a per-object cost in the build directory. The routes for
+the next build are written as empty marker files mirroring the object
+paths, so that compile.sh can look them up with a single `[ -e ]`:
+
+    .compile-routes/local/<object>   compile locally without ccache
+                                     (cheap and not cacheable)
+    .compile-routes/ccache/<object>  ccache, but compile locally on a miss
+
+All other objects go through ccache and distcc.
+
+Usage: compile-routes.py Project
+
+"""
+import json
+import os
+import shlex
+import sys
+from config import read_config
+from utils import setup_logging
+
+# Compilations shorter than this (in seconds) are cheaper done locally
+CHEAP_COST = 2.0
+# Weight of the latest build in the recorded cost
+COST_WEIGHT = 0.5
+ROUTES_DIR = '.compile-routes'
+
+config = None
+log = None
+
+
+def read_ninja_log(build_dir):
+    """Return the duration in seconds of the last build of each output."""
+    durations = {}
+    try:
+        with open(os.path.join(build_dir, '.ninja_log')) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 4:
+                    continue
+                start, end, _, output = fields[:4]
+                durations[output] = (int(end) - int(start)) / 1000
+    except FileNotFoundError:
+        pass
+    return durations
+
+
+def object_paths(build_dir):
+    """Map source files to object files using compile_commands.json."""
+    try:
+        with open(os.path.join(build_dir, 'compile_commands.json')) as f:
+            commands = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    objects = {}
+    for entry in commands:
+        output = entry.get('output')
+        if output is None:
+            args = entry.get('arguments') or shlex.split(entry['command'])
+            if '-o' not in args[:-1]:
+                continue
+            output = args[args.index('-o') + 1]
+        source = os.path.join(entry['directory'], entry['file'])
+        objects[os.path.normpath(source)] = output
+    return objects
+
+
+def read_ccache_outcomes(statslog):
+    """Return 'hit', 'miss' or 'uncacheable' for each source in statslog."""
+    outcomes = {}
+    source = None
+    with open(statslog) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#'):
+                source = os.path.normpath(line[1:].strip())
+                outcomes.setdefault(source, 'uncacheable')
+            elif source is None:
+                continue
+            elif 'hit' in line:
+                outcomes[source] = 'hit'
+            elif line == 'cache_miss':
+                outcomes[source] = 'miss'
+    return outcomes
+
+
+def update_costs(costs, durations, objects, outcomes):
+    """Update the recorded costs with the compilations of the last build.
+
+    Cache hits say nothing about the cost of a compilation and are skipped.
+
+    """
+    for source, outcome in outcomes.items():
+        obj = objects.get(source)
+        if outcome == 'hit' or obj not in durations:
+            continue
+        entry = costs.setdefault(obj, {'cost': durations[obj]})
+        entry['cost'] = round(
+            COST_WEIGHT * durations[obj] +
+            (1 - COST_WEIGHT) * entry['cost'], 3)
+        entry['uncacheable'] = outcome == 'uncacheable'
+
+
+def route(entry):
+    if entry['cost'] >= CHEAP_COST:
+        return None
+    return 'local' if entry['uncacheable'] else 'ccache'
+
+
+def write_routes(routes_dir, costs):
+    """Create the marker files, touching only the ones that change."""
+    wanted = {(route(e), obj) for obj, e in costs.items() if route(e)}
+    existing = set()
+    for kind in ['local', 'ccache']:
+        top = os.path.join(routes_dir, kind)
+        for dirpath, _, files in os.walk(top):
+            for name in files:
+                existing.add(
+                    (kind,
+                     os.path.relpath(os.path.join(dirpath, name), top)))
+    for kind, obj in existing - wanted:
+        os.remove(os.path.join(routes_dir, kind, obj))
+    for kind, obj in wanted - existing:
+        path = os.path.join(routes_dir, kind, obj)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+    return len(wanted)
+
+
+def main(args):
+    global config, log
+    if len(args) != 1:
+        exit(f"usage: {os.path.basename(__file__)} Project")
+    project, = args
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    binary_tag = os.environ['BINARY_TAG']
+    build_dir = os.path.join(config['buildPath'], project,
+                             f'build.{binary_tag}')
+    routes_dir = os.path.join(build_dir, ROUTES_DIR)
+    statslog = os.path.join(config['outputPath'], 'stats', binary_tag,
+                            f'{project}.ccache-statslog')
+    if not os.path.exists(statslog):
+        return 0
+    costs_path = os.path.join(routes_dir, 'costs.json')
+    try:
+        with open(costs_path) as f:
+            costs = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        costs = {}
+
+    update_costs(costs, read_ninja_log(build_dir), object_paths(build_dir),
+                 read_ccache_outcomes(statslog))
+    os.makedirs(routes_dir, exist_ok=True)
+    with open(costs_path + '.tmp', 'w') as f:
+        json.dump(costs, f)
+    os.replace(costs_path + '.tmp', costs_path)
+    n_local = write_routes(routes_dir, costs)
+    log.debug(f"{n_local} of {len(costs)} objects of {project} "
+              "will be compiled locally")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -7,6 +7,29 @@ if [[ "$PWD" == *"/CMakeFiles/CMakeTmp" ]]; then
     elif [[ "$CCACHE_PREFIX" == *"distcc" ]]; then
         unset CCACHE_PREFIX
     fi
+elif [ -n "$COMPILE_ROUTES" ]; then
+    # Compile cheap objects on this machine (see compile-routes.py).
+    # Keep going through distcc with only localhost, which limits the
+    # number of local compilations to the distcc local slots.
+    output=
+    prev=
+    for arg; do
+        [ "$prev" = -o ] && output=$arg && break
+        prev=$arg
+    done
+    # keep the limits on local jobs (--localslots, --localslots_cpp)
+    local_hosts="localhost/$COMPILE_LOCAL_SLOTS"
+    for host in $DISTCC_HOSTS; do
+        [[ "$host" == --localslots* ]] && local_hosts+=" $host"
+    done
+    if [ -z "$output" ]; then
+        :  # not compiling an object (e.g. linking or -E), default route
+    elif [ -e "$COMPILE_ROUTES/local/$output" ]; then
+        export DISTCC_HOSTS="$local_hosts"
+        [ -n "$CCACHE_PREFIX" ] && COMPILER_PREFIX=$CCACHE_PREFIX
+    elif [ -e "$COMPILE_ROUTES/ccache/$output" ]; then
+        export DISTCC_HOSTS="$local_hosts"
+    fi
 fi
 
 args=()
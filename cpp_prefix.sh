@@ -1,2 +1,15 @@
 #!/bin/bash
-sem --fg -j+2 --id ccache_distcc -q "$@"
+# Run the preprocessor with at most CPP_SLOTS of them at a time (see make.sh).
+# Each slot is a lock file in CPP_SLOTS_DIR, held until the command exits.
+# A random slot spreads the callers over all slots, such that each call
+# costs a single flock when a slot is free.
+exec 9>"$CPP_SLOTS_DIR/$(( RANDOM % CPP_SLOTS ))"
+flock -n 9 && exec "$@"
+# The slot is taken. Block until it is released (no polling) and record
+# the time spent waiting.
+source "$(dirname "${BASH_SOURCE[0]}")/helpers.sh"
+trace_now start
+flock 9
+trace_now end
+echo "$start $end" >> "$CPP_WAIT_LOG"
+exec "$@"
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Run commands in a reused docker container instead of a new one.
+
+With useDocker, starting a container (and the LHCb environment in it)
+for every command of a build dominates small incremental builds. Here a
+container is started in the background with lb-docker-run once, and the
+commands are run in it with `docker exec`. The container is identified
+by a hash of the lb-docker-run options (and the kerberos ticket file,
+which is mounted), so that a change of options starts a new container.
+The container stops itself after `dockerIdleTimeout` seconds without use
+(see docker/keepalive.sh), and it is replaced if it is no longer running.
+With dockerIdleTimeout set to 0, every command uses a new container.
+
+Running commands hold a shared lock on outputPath/docker/<name>.users.
+
+Usage:
+
+    docker-container.py [--exec-env VAR=VALUE]... [--workdir DIR] \\
+        LB_DOCKER_RUN_OPTIONS... -- COMMAND [ARGS...]
+    docker-container.py stop
+
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from config import read_config, DIR
+from utils import setup_logging
+
+LB_DOCKER_RUN = os.path.join(DIR, 'lb-docker-run')
+ENTRYPOINT = os.path.join(DIR, 'docker', 'entrypoint.sh')
+KEEPALIVE = os.path.join(DIR, 'docker', 'keepalive.sh')
+# Seconds to wait for a new container to be ready
+START_TIMEOUT = 120
+
+config = None
+log = None
+
+
+def state_dir():
+    return os.path.join(config['outputPath'], 'docker')
+
+
+def container_name(run_args):
+    key = [run_args]
+    krb5ccname = os.environ.get('KRB5CCNAME', '').split(':')[-1]
+    if '--kerberos' in run_args and os.path.isfile(krb5ccname):
+        # the ticket file is bind mounted, so a new file (inode) is not
+        # seen in the container
+        key.append(os.stat(krb5ccname).st_ino)
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return f'lb-stack-{digest[:12]}'
+
+
+def docker(*args, **kwargs):
+    return subprocess.run(['docker'] + list(args),
+                          stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL,
+                          universal_newlines=True,
+                          **kwargs)
+
+
+def is_running(name):
+    result = docker('inspect', '-f', '{{.State.Running}}', name)
+    return result.returncode == 0 and result.stdout.strip() == 'true'
+
+
+def start(name, run_args):
+    """Start the container in the background, return True when ready."""
+    path = os.path.join(state_dir(), name)
+    log.info(f"Starting docker container {name}")
+    docker('rm', '-f', name)
+    with open(path + '.users', 'a'):
+        os.utime(path + '.users')
+    with open(path + '.log', 'w') as out:
+        subprocess.Popen(
+            [LB_DOCKER_RUN, '--name', name, '--no-interactive', '-v',
+             state_dir()] + run_args +
+            [KEEPALIVE, path + '.users',
+             str(config['dockerIdleTimeout'])],
+            stdin=subprocess.DEVNULL,
+            stdout=out,
+            stderr=subprocess.STDOUT,
+            start_new_session=True)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        if os.path.exists(path + '.ready') and is_running(name):
+            return True
+        time.sleep(0.2)
+    log.warning(f"Docker container {name} did not start, see {path}.log")
+    docker('rm', '-f', name)
+    return False
+
+
+def ensure(name, run_args):
+    """Return True if the container is (now) running."""
+    path = os.path.join(state_dir(), name)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path + '.ready') and is_running(name):
+            return True
+        try:
+            os.remove(path + '.ready')
+        except FileNotFoundError:
+            pass
+        return start(name, run_args)
+
+
+def run(run_args, exec_env, workdir, command):
+    name = container_name(run_args)
+    os.makedirs(state_dir(), exist_ok=True)
+    users = os.path.join(state_dir(), name + '.users')
+    with open(users, 'a') as f:
+        # taken before ensure() such that the container cannot stop
+        fcntl.flock(f, fcntl.LOCK_SH)
+        if not ensure(name, run_args):
+            return None
+        os.utime(users)
+        cmd = ['docker', 'exec', '-i']
+        if sys.stdin.isatty() and sys.stdout.isatty():
+            cmd.append('-t')
+        cmd += ['-u', f'{os.getuid()}:{os.getgid()}', '-w', workdir]
+        for var in exec_env:
+            cmd += ['-e', var]
+        p = subprocess.Popen(cmd + [name, ENTRYPOINT] + command)
+        # the command gets the signals of the terminal itself
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            return p.wait()
+        finally:
+            os.utime(users)
+
+
+def stop():
+    for name in os.listdir(state_dir()):
+        if name.endswith('.ready'):
+            name = name[:-len('.ready')]
+            log.info(f"Stopping docker container {name}")
+            docker('rm', '-f', name)
+            os.remove(os.path.join(state_dir(), name + '.ready'))
+
+
+def main(args):
+    global config, log
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    if args == ['stop']:
+        if os.path.isdir(state_dir()):
+            stop()
+        return 0
+
+    exec_env = []
+    workdir = os.getcwd()
+    while args[:1] in [['--exec-env'], ['--workdir']] and len(args) > 1:
+        if args[0] == '--exec-env':
+            exec_env.append(args[1])
+        else:
+            workdir = args[1]
+        args = args[2:]
+    if '--' not in args or args.index('--') == len(args) - 1:
+        exit(f"usage: {os.path.basename(__file__)} [--exec-env VAR=VALUE]... "
+             "[--workdir DIR] LB_DOCKER_RUN_OPTIONS... -- COMMAND [ARGS...]")
+    run_args = args[:args.index('--')]
+    command = args[args.index('--') + 1:]
+
+    if config['dockerIdleTimeout']:
+        returncode = run(run_args, exec_env, workdir, command)
+        if returncode is not None:
+            return returncode
+    # a new container for this command only
+    env_args = [a for var in exec_env for a in ['-e', var]]
+    # write out the queued log records, exec does not run atexit handlers
+    logging.shutdown()
+    os.execv(LB_DOCKER_RUN, [LB_DOCKER_RUN] + run_args + env_args +
+             ['--workdir', workdir] + command)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,20 @@
+#!/bin/bash
+# Main process of a reused build container (see docker-container.py).
+# Exits when the container was not used for $2 seconds. Commands running in
+# the container hold a shared lock on the file $1.
+users=$1
+timeout=$2
+state=${users%.users}
+
+touch "$state.ready"
+# docker-container.py checks the container under this lock
+exec 9>"$state.lock"
+while sleep ${KEEPALIVE_INTERVAL:-60}; do
+    flock 9
+    idle=$(( $(date +%s) - $(stat -c %Y "$users") ))
+    if [ $idle -ge $timeout ] && flock -n -x "$users" true; then
+        rm -f "$state.ready"
+        break
+    fi
+    flock -u 9
+done
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Run a shell command in many repositories concurrently.
+
+The output of each repository is buffered and printed as a block, in the
+order the repositories were given, as soon as the ones before it are
+done. The exit status is 0 only if the command succeeded everywhere, and
+the repositories where it failed are listed at the end.
+
+Usage (see `make for-each-parallel`):
+
+    for-each.py [--jobs N] [--exclude "REPO ..."] COMMAND REPO...
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from config import cpu_count
+
+
+def run(command, repo):
+    result = subprocess.run(
+        command,
+        shell=True,
+        executable='/bin/bash',
+        cwd=repo,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    return result.returncode, result.stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=cpu_count(),
+        help='Number of repositories to run the command in at a time')
+    parser.add_argument(
+        '--exclude',
+        default='',
+        help='Space separated list of repositories to skip')
+    parser.add_argument('command')
+    parser.add_argument('repos', nargs='*')
+    args = parser.parse_args()
+
+    exclude = set(args.exclude.split())
+    repos = [
+        os.path.abspath(r) for r in args.repos
+        if os.path.isdir(r) and r not in exclude
+    ]
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = [executor.submit(run, args.command, r) for r in repos]
+        for repo, future in zip(repos, futures):
+            returncode, output = future.result()
+            sys.stdout.buffer.write(repo.encode() + b'\n' + output)
+            sys.stdout.flush()
+            if returncode != 0:
+                failed.append(os.path.basename(repo))
+    if failed:
+        print(f"Command failed in {len(failed)} of {len(repos)} "
+              f"repositories: {' '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
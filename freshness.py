@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""Skip the whole build pipeline of projects that are up to date.
+
+Running `make fast/Project/install` goes through build-env, make.sh,
+ninja and cmake install, which costs seconds even when nothing changed.
+A freshness stamp is kept in the InstallArea of each project. It is a
+digest of the source tree (HEAD and the mtime and size of every file),
+of the stamps and build state of the upstream projects, of the build
+settings and scripts of lb-stack-setup, and of the build directory
+itself. When the stamp is unchanged, there is nothing to do.
+
+Usage (see the fast/Project/install target in the Makefile):
+
+    freshness.py check Project || { build ... && freshness.py commit Project; }
+
+"""
+import hashlib
+import json
+import os
+import sys
+from subprocess import run, PIPE, DEVNULL
+from config import read_config, DIR
+from utils import (
+    setup_logging,
+    topo_sorted,
+    walk_sources,
+    read_make_config,
+    project_dependencies,
+)
+
+STAMP_NAME = '.freshness-stamp'
+# Files in the source tree that do not affect the build (generated by
+# lb-stack-setup itself)
+IGNORED_FILES = {'.env', '.clangd', 'run', 'gdb'}
+# Files that change whenever something is (re)built in a build directory
+BUILD_STATE_FILES = [
+    'build.ninja', '.ninja_log', 'CMakeCache.txt', 'install_manifest.txt'
+]
+# Settings that change how projects are built (see build-env and make.sh)
+BUILD_SETTINGS = [
+    'lcgVersion', 'lbenvPath', 'useDocker', 'useCcache', 'useDistcc',
+    'localPoolDepth', 'functorJitNJobs', 'cmakePrefixPath', 'compileRouting',
+    'forwardEnv'
+]
+# Files of lb-stack-setup that take part in every build
+BUILD_SCRIPTS = ['toolchain.cmake', 'project.mk', 'make.sh']
+
+config = None
+log = None
+
+
+def _stat_line(path, name=None):
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return f'{name or path}\0-\n'
+    return f'{name or path}\0{st.st_mtime_ns}\0{st.st_size}\n'
+
+
+def build_dir(project, binary_tag):
+    return os.path.join(config['buildPath'], project, f'build.{binary_tag}')
+
+
+def stamp_path(project, binary_tag):
+    return os.path.join(config['buildPath'], project, 'InstallArea',
+                        binary_tag, STAMP_NAME)
+
+
+def sources_digest(project):
+    """Digest HEAD and the mtime and size of all files in the worktree."""
+    path = os.path.join(config['projectPath'], project)
+    h = hashlib.sha1()
+    head = run(['git', 'rev-parse', 'HEAD'],
+               cwd=path,
+               stdout=PIPE,
+               stderr=DEVNULL).stdout
+    h.update(head)
+    for root, dirs, files in walk_sources(path):
+        for name in sorted(files):
+            if name in IGNORED_FILES or name.endswith('.pyc'):
+                continue
+            file_path = os.path.join(root, name)
+            h.update(_stat_line(file_path, os.path.relpath(file_path, path))
+                     .encode())
+    # the configuration also goes into the build
+    cmake_flags = config['cmakeFlags']
+    h.update('\0'.join([
+        cmake_flags.get('default', ''),
+        cmake_flags.get(project, ''),
+        os.environ.get('CMAKEFLAGS', ''),
+    ]).encode())
+    return h.hexdigest()
+
+
+def settings_digest():
+    """Digest the build settings and the build scripts."""
+    h = hashlib.sha1(
+        json.dumps({name: config.get(name)
+                    for name in BUILD_SETTINGS}, sort_keys=True).encode())
+    for name in BUILD_SCRIPTS:
+        h.update(_stat_line(os.path.join(DIR, name), name).encode())
+    return h.hexdigest()
+
+
+def upstream_digest(project, deps, binary_tag):
+    """Digest the stamps and the build state of all upstream projects."""
+    h = hashlib.sha1()
+    for dep in topo_sorted(deps, [project]):
+        if dep == project:
+            continue
+        try:
+            with open(stamp_path(dep, binary_tag)) as f:
+                h.update(f'{dep}\0{f.read()}\n'.encode())
+        except FileNotFoundError:
+            h.update(f'{dep}\0-\n'.encode())
+        h.update(build_dir_digest(dep, binary_tag).encode())
+    return h.hexdigest()
+
+
+def build_dir_digest(project, binary_tag):
+    path = build_dir(project, binary_tag)
+    h = hashlib.sha1()
+    for name in BUILD_STATE_FILES:
+        h.update(_stat_line(os.path.join(path, name), name).encode())
+    return h.hexdigest()
+
+
+def compute_stamp(project, deps, binary_tag):
+    return {
+        'sources': sources_digest(project),
+        'settings': settings_digest(),
+        'upstream': upstream_digest(project, deps, binary_tag),
+        'build': build_dir_digest(project, binary_tag),
+    }
+
+
+def read_stamp(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def check(project, deps, binary_tag):
+    """Return True if the project is up to date.
+
+    Otherwise, save the current state of the sources and the upstream
+    projects, to be committed after a successful build.
+
+    """
+    path = stamp_path(project, binary_tag)
+    stamp = compute_stamp(project, deps, binary_tag)
+    if stamp == read_stamp(path):
+        return True
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.pending', 'w') as f:
+        json.dump(stamp, f)
+    return False
+
+
+def commit(project, binary_tag):
+    """Record the stamp after a successful build.
+
+    The sources and upstream digests are taken from before the build so
+    that changes done during the build are not missed.
+
+    """
+    path = stamp_path(project, binary_tag)
+    stamp = read_stamp(path + '.pending')
+    if stamp is None:
+        return
+    stamp['build'] = build_dir_digest(project, binary_tag)
+    with open(path + '.pending', 'w') as f:
+        json.dump(stamp, f)
+    os.replace(path + '.pending', path)
+
+
+def main(args):
+    global config, log
+    if len(args) != 2 or args[0] not in ['check', 'commit']:
+        exit(f"usage: {os.path.basename(__file__)} check|commit Project")
+    command, project = args
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    binary_tag = os.environ['BINARY_TAG']
+
+    if command == 'commit':
+        commit(project, binary_tag)
+        return 0
+
+    if not config['projectStamps']:
+        return 1
+    variables = read_make_config(
+        os.path.join(config['outputPath'], f'configuration-{binary_tag}.mk'))
+    if check(project, project_dependencies(variables), binary_tag):
+        log.info(f"{project} is up to date ({binary_tag})")
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -19,6 +19,36 @@ setup_output() {
         OUTPUT=/tmp/lb-stack-setup-$USER
         mkdir -p "$OUTPUT/$PROJECT"
     fi
+    # rotate the log like utils.setup_logging does (needs logMaxSize and logMaxAge)
+    if [ -n "$logMaxSize" -a -n "$(find "$OUTPUT/log" -size +${logMaxSize}M 2>/dev/null)" ] || _log_too_old; then
+        ( cd "$_helpers_dir"; python3 -c 'import sys, utils; utils.rotate_log_if_needed(sys.argv[1])' "$OUTPUT" ) || true
+    fi
+}
+
+# Whether the first record of the log is older than logMaxAge days
+_log_too_old() {
+    local start
+    [ -n "$logMaxAge" ] || return 1
+    start=$(head -c 19 "$OUTPUT/log" 2>/dev/null)
+    [ -n "$start" ] && [[ "$start" < "$(date -d "$logMaxAge days ago" +%Y-%m-%dT%H:%M:%S)" ]]
+}
+
+# Check for a valid ticket and renew it from time to time.
+# Logs with level $1 and returns 1 if there is no valid ticket.
+check_kerberos() {
+    local level=$1 klist_pid
+    klist -l | grep -q "@CERN\.CH" & klist_pid=$!  # run klist -s and klist -l in parallel
+    if ! { klist -s && wait $klist_pid; }; then
+        log $level "No valid ticket found. Please get a new one with"
+        log $level
+        log $level "    kinit -r 7d <username>@CERN.CH"
+        log $level
+        return 1
+    elif [ -z "$(find "$OUTPUT/krb_renewal.timestamp" -mmin -30 2>/dev/null)" ]; then
+        # Try to renew ticket every 30 min
+        touch "$OUTPUT/krb_renewal.timestamp"
+        kinit -R 2>/dev/null || true  # if this fails, the ticket is not renewable
+    fi
 }
 
 gitc() { pushd "$1" >/dev/null && git "${@:2}" && popd >/dev/null; }
@@ -36,4 +66,35 @@ log() {
     printf "%s %-15s %-8s %s\n" "$ts" "${logname:-bash}" "$1" "$2" >> "$OUTPUT/log" || true
 }
 
+# Set the variable $1 to the current time in seconds
+trace_now() {
+    if [ -n "$EPOCHREALTIME" ]; then
+        printf -v "$1" '%s' "${EPOCHREALTIME/,/.}"  # decimal comma locales
+    else
+        printf -v "$1" '%s' "$(date +%s.%N)"
+    fi
+}
+
+# Set the variable $1 to the JSON string of $2
+_json_string() {
+    local s=${2//\\/\\\\}
+    printf -v "$1" '"%s"' "${s//\"/\\\"}"
+}
+
+# Append a timing record for phase $1 started at $2 (see trace_now) with
+# return code $3 to $OUTPUT/trace.jsonl (see trace-report.py).
+trace_record() {
+    [ -n "$OUTPUT" ] || return 0
+    local end name invocation script cwd project
+    trace_now end
+    _json_string project "$PROJECT"
+    _json_string name "$1"
+    _json_string invocation "$LBSTACK_INVOCATION"
+    _json_string script "${logname:-bash}"
+    _json_string cwd "$PWD"
+    printf '{"kind": "phase", "name": %s, "start": %s, "end": %s, "returncode": %s, "invocation": %s, "pid": %s, "script": %s, "cwd": %s, "project": %s}\n' \
+        "$name" "$2" "$end" "${3:-null}" "$invocation" $$ "$script" "$cwd" "$project" \
+        >> "$OUTPUT/trace.jsonl" || true
+}
+
 # TODO log *everything* with https://askubuntu.com/a/1001404/417217
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Install a project incrementally (see the install target in project.mk).
+
+`cmake -P cmake_install.cmake` compares every installed file with its
+source and prints a line for each, even when nothing was rebuilt. Here
+the install is skipped altogether when neither the build (build.ninja,
+.ninja_log, cmake_install.cmake) nor the source tree changed since the
+last install, and all files in install_manifest.txt are still there.
+The state of the source tree is the sources digest that freshness.py
+just computed for the pending stamp, so that the tree is not walked a
+second time. Without a pending stamp (e.g. with projectStamps off), the
+tree is walked here.
+
+Otherwise cmake installs as usual, and the files it installed that are
+identical to a file in the build directory are replaced by a hard link
+to it (see installHardlinks), so that the InstallArea does not take the
+disk space of the build directory again. The linker and ninja replace
+outputs instead of writing into them, so a rebuild never changes an
+installed file behind cmake's back. Files modified at install time
+(e.g. with a changed RPATH) and files on another filesystem (e.g. with
+targetBuildPath) stay copies.
+
+Usage: install-project.py BUILD_DIR SOURCE_DIR
+
+"""
+import filecmp
+import json
+import os
+import subprocess
+import sys
+from config import read_config
+from utils import setup_logging, walk_sources
+from freshness import STAMP_NAME, read_stamp
+
+STAMP = '.install-stamp'
+# Build files that change whenever something was (re)built or configured
+BUILD_FILES = ['build.ninja', '.ninja_log', 'Makefile', 'cmake_install.cmake']
+
+config = None
+log = None
+
+
+def source_state(source_dir):
+    """Return the number of entries and latest mtime in the source tree."""
+    count = 0
+    latest = 0
+    for dirpath, dirs, files in walk_sources(source_dir):
+        for name in dirs + files:
+            try:
+                st = os.stat(
+                    os.path.join(dirpath, name), follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            count += 1
+            latest = max(latest, st.st_mtime_ns)
+    return [count, latest]
+
+
+def pending_sources_digest(build_dir):
+    """Return the sources digest of the pending freshness stamp (or None)."""
+    if not config['projectStamps']:
+        return None
+    binary_tag = os.path.basename(build_dir)[len('build.'):]
+    path = os.path.join(
+        os.path.dirname(build_dir), 'InstallArea', binary_tag,
+        STAMP_NAME + '.pending')
+    return (read_stamp(path) or {}).get('sources')
+
+
+def stamp(build_dir, source_dir):
+    state = {}
+    for name in BUILD_FILES:
+        try:
+            st = os.stat(os.path.join(build_dir, name))
+            state[name] = [st.st_size, st.st_mtime_ns]
+        except FileNotFoundError:
+            pass
+    state['sources'] = (pending_sources_digest(build_dir)
+                        or source_state(source_dir))
+    return state
+
+
+def read_manifest(build_dir):
+    try:
+        with open(os.path.join(build_dir, 'install_manifest.txt')) as f:
+            return [line.rstrip('\n') for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+
+
+def is_up_to_date(build_dir, state):
+    try:
+        with open(os.path.join(build_dir, STAMP)) as f:
+            if json.load(f) != state:
+                return False
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    manifest = read_manifest(build_dir)
+    return manifest is not None and all(
+        os.path.lexists(path) for path in manifest)
+
+
+def cmake_install(build_dir):
+    """Run the cmake install script, return the installed files."""
+    installed = []
+    with subprocess.Popen(['cmake', '-P', 'cmake_install.cmake'],
+                          cwd=build_dir,
+                          stdout=subprocess.PIPE,
+                          universal_newlines=True) as p:
+        for line in p.stdout:
+            if line.startswith('-- Up-to-date:'):
+                continue
+            sys.stdout.write(line)
+            if line.startswith('-- Installing:'):
+                installed.append(line.split(':', 1)[1].strip())
+    return p.returncode, installed
+
+
+def build_files_by_stat(build_dir, install_dir):
+    """Index the regular files of the build directory by name, size, mtime."""
+    files = {}
+    for dirpath, dirs, names in os.walk(build_dir):
+        dirs[:] = [
+            d for d in dirs if os.path.join(dirpath, d) != install_dir
+            and d not in ['CMakeFiles', 'Testing', '.compile-routes']
+        ]
+        for name in names:
+            path = os.path.join(dirpath, name)
+            st = os.stat(path, follow_symlinks=False)
+            if st.st_size and os.path.isfile(path) and \
+                    not os.path.islink(path):
+                files.setdefault((name, st.st_size, int(st.st_mtime)),
+                                 []).append(path)
+    return files
+
+
+def link_installed(build_dir, installed):
+    """Replace installed copies of build products with hard links."""
+    if not installed:
+        return 0
+    install_dir = os.path.commonpath(installed)
+    candidates = build_files_by_stat(build_dir, install_dir)
+    linked = 0
+    for path in installed:
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        if os.path.islink(path) or st.st_nlink > 1:
+            continue
+        # cmake gives the installed files the mtime of their source (with
+        # a lower precision), and at most the permissions of the source.
+        # Only link files with the same name, such that cmake never writes
+        # into a build file when installing a different one.
+        key = (os.path.basename(path), st.st_size, int(st.st_mtime))
+        for source in candidates.get(key, []):
+            if st.st_mode & ~os.stat(source).st_mode or \
+                    not filecmp.cmp(source, path, shallow=False):
+                continue
+            tmp = path + '.install-link'
+            try:
+                os.link(source, tmp)
+            except OSError:  # e.g. another filesystem
+                return linked
+            os.replace(tmp, path)
+            linked += 1
+            break
+    return linked
+
+
+def main(args):
+    global config, log
+    if len(args) != 2:
+        exit(f"usage: {os.path.basename(__file__)} BUILD_DIR SOURCE_DIR")
+    build_dir, source_dir = map(os.path.abspath, args)
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+
+    state = stamp(build_dir, source_dir)
+    if is_up_to_date(build_dir, state):
+        log.debug(f"{build_dir} is already installed")
+        return 0
+    try:
+        os.remove(os.path.join(build_dir, STAMP))
+    except FileNotFoundError:
+        pass
+    returncode, installed = cmake_install(build_dir)
+    if returncode != 0:
+        return returncode
+    if config['installHardlinks']:
+        linked = link_installed(build_dir, installed)
+        if linked:
+            log.debug(f"Hard linked {linked} of {len(installed)} "
+                      "installed files to the build directory")
+    with open(os.path.join(build_dir, STAMP), 'w') as f:
+        json.dump(state, f)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
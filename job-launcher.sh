@@ -0,0 +1,14 @@
+#!/bin/bash
+# Launcher of link and custom commands (see toolchain.cmake).
+# Links, reflex dictionaries and the functor cache are run by job-pools.py,
+# which records their peak memory, other custom commands are run directly.
+kind=$1
+shift
+if [ "$kind" = custom ]; then
+  case "$*" in
+    *genreflex*) kind=genreflex ;;
+    *[Ff]unctor[Cc]ache*|*functor_cache*) kind=jit ;;
+    *) exec "$@" ;;
+  esac
+fi
+exec "$(dirname "${BASH_SOURCE[0]}")/job-pools.py" record "$kind" "$@"
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Size the ninja pools of memory hungry jobs by their peak memory.
+
+Links, reflex dictionaries (genreflex) and the functor JIT use much more
+memory than compilations, so running as many of them as there are CPUs
+can exhaust the memory of the machine. Each of them runs in its own pool
+(see toolchain.cmake), whose depth is the memory available for the build
+divided by the peak RSS of that kind of job:
+- the available memory is `MemAvailable` times `jobPoolMemoryFraction`,
+  scaled by the job share of the project when several are built at once
+  (BUILD_JOBS, see scheduler.py),
+- the peak RSS is a high percentile of the recent jobs of that kind,
+  recorded by job-launcher.sh, or `jobPoolMemory` without enough history.
+The depths are at most `localPoolDepth`. The functor JIT runs in the
+jobs, so for it the depth is THOR_JIT_N_JOBS (at most `functorJitNJobs`).
+
+The pools are defined at configure time, and the depths in rules.ninja
+of an existing build directory are updated before each build, so that
+they follow the memory and the history without re-running CMake.
+
+Usage:
+
+    eval "$(job-pools.py depths [BUILD_DIR])"  # in make.sh
+    job-pools.py record KIND COMMAND...          # from job-launcher.sh
+
+"""
+import fcntl
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import time
+from config import read_config, cpu_count
+from utils import setup_logging, available_memory
+
+HISTORY = 'job-rss.jsonl'
+HISTORY_MAX_SIZE = 1024**2
+SAMPLES = 200  # recent jobs of each kind considered
+MIN_SAMPLES = 5
+PERCENTILE = 0.9
+GB = 1024**3
+# kind of job: (ninja pool, environment variable with its depth)
+POOLS = {
+    'link': ('link_pool', 'LINK_POOL_DEPTH'),
+    'genreflex': ('genreflex_pool', 'GENREFLEX_POOL_DEPTH'),
+    'jit': (None, 'THOR_JIT_N_JOBS'),
+}
+POOL_RE = re.compile(r'^pool (?P<name>\w+)\n  depth = (?P<depth>\d+)$', re.M)
+
+config = None
+log = None
+
+
+def history_path():
+    return os.path.join(config['outputPath'], HISTORY)
+
+
+def record(kind, cmd):
+    """Run a job and append its peak RSS to the history."""
+    start = time.time()
+    try:
+        returncode = subprocess.call(cmd)
+    except OSError as e:
+        print(f"{os.path.basename(__file__)}: {cmd[0]}: {e}", file=sys.stderr)
+        return 127
+    if returncode == 0:
+        # ru_maxrss (in kB) is the largest of the waited for descendants
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        line = json.dumps({
+            'kind': kind,
+            'rss': rss,
+            'duration': round(time.time() - start, 3),
+        }) + '\n'
+        path = os.path.join(
+            os.environ.get('OUTPUT_PATH') or read_config()['outputPath'],
+            HISTORY)
+        try:
+            with open(path, 'a') as f:
+                f.write(line)  # a single append is atomic
+        except OSError:
+            pass
+    return returncode
+
+
+def read_history():
+    """Return the recent peak RSS of each kind, trimming the history."""
+    samples = {kind: [] for kind in POOLS}
+    path = history_path()
+    try:
+        with open(path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lines = f.readlines()
+            for line in lines:
+                try:
+                    r = json.loads(line)
+                    samples[r['kind']].append(r['rss'])
+                except (ValueError, KeyError):
+                    pass  # partially written or unknown kind
+            if f.tell() > HISTORY_MAX_SIZE:
+                f.seek(0)
+                f.truncate()
+                f.writelines(lines[-SAMPLES * len(POOLS):])
+    except FileNotFoundError:
+        pass
+    return {kind: rss[-SAMPLES:] for kind, rss in samples.items()}
+
+
+def peak_memory(kind, samples):
+    if len(samples) < MIN_SAMPLES:
+        return config['jobPoolMemory'][kind] * GB
+    return sorted(samples)[int(PERCENTILE * (len(samples) - 1))]
+
+
+def pool_depths():
+    """Return the depth of each kind of job."""
+    memory = available_memory()
+    if memory is None:
+        return {}
+    memory *= config['jobPoolMemoryFraction']
+    jobs = int(os.environ.get('BUILD_JOBS') or 0)
+    if jobs:
+        budget = config['buildJobs'] or (cpu_count() + 2)
+        memory *= min(1, jobs / budget)
+    history = read_history()
+    depths = {}
+    for kind in POOLS:
+        limit = (config['functorJitNJobs']
+                 if kind == 'jit' else config['localPoolDepth'])
+        limit = limit or 2 * cpu_count()
+        peak = peak_memory(kind, history[kind])
+        depths[kind] = max(1, min(limit, int(memory / peak)))
+        log.debug(f"{kind}: {peak / GB:.1f} GB peak RSS "
+                  f"({len(history[kind])} recorded), depth {depths[kind]}")
+    return depths
+
+
+def update_rules(build_dir, depths):
+    """Set the depths of the pools in the rules.ninja of build_dir."""
+    path = os.path.join(build_dir, 'CMakeFiles', 'rules.ninja')
+    try:
+        with open(path) as f:
+            rules = f.read()
+    except FileNotFoundError:
+        return
+    pools = {pool: depths[kind] for kind, (pool, _) in POOLS.items() if pool}
+    changed = []
+
+    def replace(m):
+        depth = pools.get(m.group('name'))
+        if depth is None or depth == int(m.group('depth')):
+            return m.group(0)
+        changed.append(f"{m.group('name')} {m.group('depth')} -> {depth}")
+        return f"pool {m.group('name')}\n  depth = {depth}"
+
+    rules = POOL_RE.sub(replace, rules)
+    if changed:
+        log.info(f"Adjusting job pools to the available memory: "
+                 f"{', '.join(changed)}")
+        # keep the mtime, so that ninja does not consider it changed
+        st = os.stat(path)
+        with open(path + '.tmp', 'w') as f:
+            f.write(rules)
+        os.utime(path + '.tmp', ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(path + '.tmp', path)
+
+
+def main(args):
+    global config, log
+    if not (args[:1] == ['depths'] and len(args) <= 2
+            or args[:1] == ['record'] and len(args) >= 3):
+        exit(f"usage: {os.path.basename(__file__)} depths [BUILD_DIR] | "
+             "record KIND COMMAND...")
+    if args[0] == 'record':
+        return record(args[1], args[2:])
+
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    depths = pool_depths()
+    if depths:
+        if len(args) > 1:
+            update_rules(args[1], depths)
+        for kind, (_, variable) in POOLS.items():
+            print(f"export {variable}={depths[kind]}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -9,6 +9,7 @@ set -eo pipefail
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 source "$DIR/helpers.sh"
 logname="make.sh"
+trace_now trace_start
 
 if [ "$#" -lt 2 ]; then
     echo "usage: $(basename $0) project targets" >&2
@@ -18,7 +19,8 @@ PROJECT="$1"
 shift
 
 # steering options
-source_config outputPath contribPath buildPath targetBuildPath ccachePath useCcache useDistcc cmakePrefixPath \
+source_config outputPath contribPath buildPath targetBuildPath ccachePath useCcache useDistcc cmakePrefixPath compileRouting \
+              artifactCachePath logMaxSize logMaxAge \
                    'ccacheHosts=ccacheHosts or ccacheHostsPresets.get(ccacheHostsKey, "")'
 OUTPUT=$outputPath
 CONTRIB=$contribPath
@@ -29,7 +31,20 @@ USE_DISTCC_PUMP=true
 # DEBUG_DISTCC=true; USE_CCACHE=false
 # DEBUG_CCACHE=true
 setup_output
-printenv | sort > "$OUTPUT/make.sh.env"
+# replaced atomically as several projects (and platforms) build at once
+printenv | sort > "$OUTPUT/make.sh.env.$$" && mv -f "$OUTPUT/make.sh.env.$$" "$OUTPUT/make.sh.env"
+trace_record "make.sh config" $trace_start
+trap 'trace_record "make.sh $*" $trace_start $?' EXIT
+
+# Anything we do may change the build, so invalidate the freshness stamp.
+# It is recreated after a successful install (see freshness.py).
+rm -f "$BUILD_PATH/$PROJECT/InstallArea/$BINARY_TAG/.freshness-stamp"
+
+# Size the pools of links, dictionaries and the functor JIT by the available
+# memory and their peak memory in previous builds (see job-pools.py)
+if [ "$*" != clean ]; then
+  eval "$("$DIR/job-pools.py" depths "${targetBuildPath:-$BUILD_PATH}/$PROJECT/build.$BINARY_TAG")" || true
+fi
 
 # explicitly define a fast TMPDIR, unless debugging
 if [ "$DEBUG_CCACHE" = true -o "$DEBUG_DISTCC" = true ]; then
@@ -107,65 +122,39 @@ setup_ccache() {
 
 
 pump_startup() {
-  # start the include server manually (instead of pump --startup) for more control
-  local include_server_install=$(python -c "
-import sysconfig
-print(sysconfig.get_path('purelib', vars={'base': '$CONTRIB'}))
-  ")/include_server
-  local pid_file="$OUTPUT/distcc-pump.pid"
-
-  # kill stray include servers (as pump relies on no changes during build)
-  pkill -f "$include_server_install/include_server.py --port" || true
-
-  if [ "$DEBUG_DISTCC" = true ]; then
-    # --time = Print elapsed, user, and system time to stderr.
-    # --statistics = Print information to stdout about include analysis.
-    # --debug_pattern : 19 = 1 (warning) + 2 (trace 0) + 16 (data); 31 = everything
-    local debug_args="--time --statistics --debug_pattern=19"
-    # debug_args="$debug_args --path_observation_re=/cvmfs"
-  else
-    local debug_args="--debug_pattern=1"  # only warnings
-  fi
-
-  # Variable used by "pump --shutdown" (see pump_shutdown)
-  export INCLUDE_SERVER_DIR=$(mktemp -d -t distcc-pump-socket-XXXXXX)
-  # Variable used by the distcc client
-  export INCLUDE_SERVER_PORT="$INCLUDE_SERVER_DIR/socket"
-
-  mkdir -p "$OUTPUT"
-
-  # TODO add a separator line to the stdout/stderr or rotate logs
-  # Start the include server directly, avoiding the `pump` wrapper.
-  # This allows more control, e.g. to chose the version of python
-  # (not necessarily the one used to build )
-  local cmd="PYTHONPATH='$PYTHONPATH:$include_server_install' \
-    python '$include_server_install/include_server.py' \
-      --port '$INCLUDE_SERVER_PORT' --pid_file '$pid_file' \
-      $debug_args"
-  if [ "$DEBUG_DISTCC" != true ]; then
-    cmd="$cmd >'$OUTPUT/distcc-pump.stdout' 2>'$OUTPUT/distcc-pump.stderr'"
-  fi
-  eval $cmd
-
-  # Variable used by "pump --shutdown" (see pump_shutdown)
-  export INCLUDE_SERVER_PID=$(cat "$pid_file")
+  # Reuse the include server of this stack and platform if it is still valid,
+  # see pump.py. Hold a shared lock on $INCLUDE_SERVER_USERS while building
+  # so that the server is not stopped as idle in the meantime.
+  local pump_env args=()
+  [ "$DEBUG_DISTCC" = true ] && args+=(--debug)
+  [ -n "$PROJECT" ] && args+=(--project "$PROJECT")
+  pump_env=$("$DIR/pump.py" start "${args[@]}")
+  eval "$pump_env"
+  exec 8>>"$INCLUDE_SERVER_USERS"
+  flock -s 8
 }
 
 
 pump_shutdown() {
-  # TODO add a separator line to the stdout/stderr or rotate logs
-  pump --shutdown | grep -v '___Shutting down' || true
-  # The $INCLUDE_SERVER_PORT socket and $INCLUDE_SERVER_DIR directory are removed by pump
-  unset INCLUDE_SERVER_DIR INCLUDE_SERVER_PORT INCLUDE_SERVER_PID
+  # The include server is kept running for the next build (unless it was
+  # replaced, then its reaper stops it)
+  touch "$INCLUDE_SERVER_USERS" 2>/dev/null || true
+  # save its statistics so far for this build (see the stats script)
+  if [ "$DEBUG_DISTCC" != true ]; then
+    mkdir -p "$OUTPUT/stats/$BINARY_TAG"
+    "$DIR/pump.py" snapshot "$INCLUDE_SERVER_PID" "$OUTPUT/stats/$BINARY_TAG/$PROJECT.pump-stats" || true
+  fi
+  exec 8>&-
+  unset INCLUDE_SERVER_PORT INCLUDE_SERVER_USERS INCLUDE_SERVER_PID
 }
 
 
 setup_distcc_hosts() {
-  # TODO setup_distcc_hosts is slow when outside CERN.
-  # Consider doing port forwarding it a distcc wrapper.
-
-  local distcc_env
-  if ! distcc_env=$("$DIR/setup-distcc.py"); then
+  # Hosts are probed concurrently and the result is cached for a short
+  # time, see setup-distcc.py.
+  local distcc_env args=()
+  [ "$USE_DISTCC_PUMP" = true ] && args+=(--pump)
+  if ! distcc_env=$("$DIR/setup-distcc.py" "${args[@]}"); then
     return 1
   fi
   eval $distcc_env
@@ -183,6 +172,12 @@ setup_distcc() {
       export CCACHE_NOCPP2=1
       # limit local preprocessing by ccache as doing 100s at a time is bad
       export CCACHE_PREFIX_CPP="$DIR/cpp_prefix.sh"
+      # the slots are shared with concurrent builds
+      export CPP_SLOTS=$(( $(nproc) + 2 ))
+      export CPP_SLOTS_DIR="$TMPDIR/cpp-slots"
+      export CPP_WAIT_LOG="$OUTPUT/stats/$BINARY_TAG/$PROJECT.cpp-wait"
+      mkdir -p "$CPP_SLOTS_DIR" "$(dirname "$CPP_WAIT_LOG")"
+      rm -f "$CPP_WAIT_LOG"
     fi
 
     # DEBUGGING
@@ -199,6 +194,12 @@ setup_distcc() {
       # stop on include server failure rather than preprocess locally
       # export DISTCC_TESTING_INCLUDE_SERVER=1  # undocumented variable
       export BUILDFLAGS="$BUILDFLAGS -j1"  # one job at a time
+    else
+      # Keep the warnings (e.g. local fallbacks) for the distcc model,
+      # see setup-distcc.py --record
+      export DISTCC_LOG="$OUTPUT/stats/$BINARY_TAG/$PROJECT.distcc-log"
+      mkdir -p "$(dirname "$DISTCC_LOG")"
+      rm -f "$DISTCC_LOG"
     fi
   else
     log ERROR "Failed to set up hosts for distcc"
@@ -206,22 +207,24 @@ setup_distcc() {
   fi
 }
 
+# Check if any of the targets causes compilation
+COMPILING=false
+for TARGET in "$@"; do
+  if [[ ! "purge clean configure test" =~ (^|[[:space:]])"$TARGET"($|[[:space:]]) ]]; then
+    COMPILING=true
+  fi
+done
 # Disable distcc if all targets do not cause compilation
-if [ "$USE_DISTCC" = true ]; then
-  USE_DISTCC=false
-  for TARGET in "$@"; do
-    if [[ ! "purge clean configure test" =~ (^|[[:space:]])"$TARGET"($|[[:space:]]) ]]; then
-      USE_DISTCC=true
-    fi
-  done
-fi
+[ "$COMPILING" = true ] || USE_DISTCC=false
 
 # Disable distcc when there are few cxx to build.
 # This saves the overheads when iterating on some file.
 if [ "$USE_DISTCC" = true -a "$DEBUG_DISTCC" != true ]; then
   if [ -f "$BUILD_PATH/$PROJECT/build.$BINARY_TAG/build.ninja" ]; then
+    trace_now t
     ninja_todo=$("$CONTRIB/bin/ninja" -C "$BUILD_PATH/$PROJECT/build.$BINARY_TAG" -n | \
       grep 'Building CXX object\|Re-running CMake' | head -2 || true)
+    trace_record "ninja -n" $t
     # do not disable distcc when rerunning CMake
     if [[ $ninja_todo != *'CMake'* ]]; then
       n_cxx_to_build=$(printf '%s' "$ninja_todo" | wc -l)
@@ -232,8 +235,18 @@ if [ "$USE_DISTCC" = true -a "$DEBUG_DISTCC" != true ]; then
   fi
 fi
 
+trace_now t
 [ "$USE_CCACHE" = true ] && setup_ccache
 [ "$USE_DISTCC" = true ] && setup_distcc
+trace_record "setup ccache/distcc" $t
+
+# Use the share of the job budget given by scheduler.py. With distcc, take
+# the same share of the -j from setup-distcc.py (the last -j wins).
+if [ -n "$BUILD_JOBS" -a "$USE_DISTCC" != true ]; then
+  export BUILDFLAGS="$BUILDFLAGS -j$BUILD_JOBS"
+elif [ -n "$BUILD_JOBS" -a -n "$BUILD_JOBS_BUDGET" -a -n "$distcc_jobs" -a "$DEBUG_DISTCC" != true ]; then
+  export BUILDFLAGS="$BUILDFLAGS -j$(( (distcc_jobs * BUILD_JOBS + BUILD_JOBS_BUDGET - 1) / BUILD_JOBS_BUDGET ))"
+fi
 
 # Define compiler prefix used in compile.sh
 if [ "$USE_CCACHE" = true ]; then
@@ -245,6 +258,22 @@ elif [ "$USE_DISTCC" = true ]; then
   export COMPILER_PREFIX="$DIR/../contrib/bin/distcc"
 fi
 
+# Pull the cache entries of the objects to be rebuilt from the remote
+# storage in bulk before the build, see ccache-prefetch.py
+if [ "$USE_CCACHE" = true -a -n "$CCACHE_SECONDARY_STORAGE" -a "$COMPILING" = true \
+     -a "$DEBUG_CCACHE" != true ]; then
+  trace_now t
+  "$DIR/ccache-prefetch.py" "$BUILD_PATH/$PROJECT/build.$BINARY_TAG" || true
+  trace_record "ccache-prefetch" $t
+fi
+
+# Compile cheap objects locally, see compile-routes.py
+if [ "$USE_CCACHE" = true -a "$USE_DISTCC" = true -a "$compileRouting" = true \
+     -a "$DEBUG_DISTCC" != true ]; then
+  export COMPILE_ROUTES="$BUILD_PATH/$PROJECT/build.$BINARY_TAG/.compile-routes"
+  export COMPILE_LOCAL_SLOTS=$(nproc)
+fi
+
 compile_commands_src="$BUILD_PATH/$PROJECT/build.$BINARY_TAG/compile_commands.json"
 compile_commands_dst="$OUTPUT/$PROJECT/compile_commands.json"
 runtime_env_src="$BUILD_PATH/$PROJECT/build.$BINARY_TAG/python.env"
@@ -257,7 +286,7 @@ runtime_env_dst2="$PROJECT/.env"  # needed for Python debugging config
 # Also, it is useful to have the stack directory so that we can automatically
 # override things like lcg-toolchains.
 export CMAKE_PREFIX_PATH="$LBENV_CURRENT_WORKSPACE:$cmakePrefixPath"
-printenv | sort > "$OUTPUT/project.mk.env"
+printenv | sort > "$OUTPUT/project.mk.env.$$" && mv -f "$OUTPUT/project.mk.env.$$" "$OUTPUT/project.mk.env"
 if [ "$PROJECT" = monohack ]; then  # FIXME this is a hack for the cmake wrapper!
   "$@"
 else
@@ -279,7 +308,23 @@ else
       )
   fi
 
-  make -f "$DIR/project.mk" -C "$PROJECT" "BUILDDIR=$BUILD_PATH/$PROJECT/build.$BINARY_TAG" "$@"
+  # Restore a snapshot of an identical build instead of building it,
+  # see artifact-cache.py
+  artifact_key=
+  trace_now t
+  if [ -n "$artifactCachePath" -a "$*" = install ]; then
+    artifact_key=$("$DIR/artifact-cache.py" key "$PROJECT" || true)
+  fi
+  if [ -n "$artifact_key" ] && "$DIR/artifact-cache.py" restore "$PROJECT" "$artifact_key"; then
+    trace_record "artifact-cache restore" $t
+  else
+    trace_now t
+    make -f "$DIR/project.mk" -C "$PROJECT" "BUILDDIR=$BUILD_PATH/$PROJECT/build.$BINARY_TAG" "$@"
+    trace_record "project.mk $*" $t
+    if [ -n "$artifact_key" ]; then
+      "$DIR/artifact-cache.py" save "$PROJECT" "$artifact_key" || true
+    fi
+  fi
 fi
 # cd "$BUILD_PATH/$PROJECT/build.$BINARY_TAG" && ninja $BUILDFLAGS "$@" && cd -
 # TODO catch CTRL-C during make here and do the clean up, see
@@ -292,10 +337,21 @@ if [ "$USE_DISTCC" = true ]; then
   if [ "$USE_DISTCC_PUMP" = true ]; then
     pump_shutdown
   fi
+  if [ "$DEBUG_DISTCC" != true ]; then
+    "$DIR/setup-distcc.py" --record "$PROJECT" || true
+  fi
 fi
 if [ "$USE_CCACHE" = true ]; then
   ccache --show-log-stats -v | grep -v ' 0$'
 fi
+if [ -n "$COMPILE_ROUTES" ]; then
+  "$DIR/compile-routes.py" "$PROJECT" || true
+fi
+if [ "$USE_CCACHE" = true ]; then
+  # keep the caches within ccacheBudget, at most once a day and in the
+  # background (see ccache-budget.py)
+  nohup nice -n 19 "$DIR/ccache-budget.py" --if-due >/dev/null 2>&1 &
+fi
 
 # Create symlinks if building outside of stack
 # rel_build_dir=$PROJECT/build.$BINARY_TAG
@@ -316,21 +372,24 @@ fi
 #   fi
 # fi
 
-# Copy compile commands and runtime environment if changed
-cmp --silent "$compile_commands_src" "$compile_commands_dst" \
-  || cp -f "$compile_commands_src" "$compile_commands_dst" 2>/dev/null \
-  || true
-run_cmd="$BUILD_PATH/$PROJECT/build.$BINARY_TAG/run"
-if [ -f $run_cmd ]; then
-  # TODO the following costs about 0.2s, should only run it if the xenv changed
-  # Filter out PYTHONHOME to workaround an issue in the VSCode python extension,
-  # where the python interpreter is run in the wrong .env and causes a SIGABRT.
-  if ( $run_cmd env 2>/dev/null | grep -v '^PYTHONHOME=' >"$runtime_env_src" ) ; then
-    if ! cmp --silent "$runtime_env_src" "$runtime_env_dst" ; then
-      cp -f "$runtime_env_src" "$runtime_env_dst" 2>/dev/null || true
-    fi
-    if ! cmp --silent "$runtime_env_src" "$runtime_env_dst2" ; then
-      cp -f "$runtime_env_src" "$runtime_env_dst2" 2>/dev/null || true
+# Copy compile commands and runtime environment if changed. When building
+# several platforms at once, only IDE_BINARY_TAG (see scheduler.py) does.
+if [ -z "$IDE_BINARY_TAG" -o "$IDE_BINARY_TAG" = "$BINARY_TAG" ]; then
+  cmp --silent "$compile_commands_src" "$compile_commands_dst" \
+    || cp -f "$compile_commands_src" "$compile_commands_dst" 2>/dev/null \
+    || true
+  run_cmd="$BUILD_PATH/$PROJECT/build.$BINARY_TAG/run"
+  if [ -f $run_cmd ]; then
+    # TODO the following costs about 0.2s, should only run it if the xenv changed
+    # Filter out PYTHONHOME to workaround an issue in the VSCode python extension,
+    # where the python interpreter is run in the wrong .env and causes a SIGABRT.
+    if ( $run_cmd env 2>/dev/null | grep -v '^PYTHONHOME=' >"$runtime_env_src" ) ; then
+      if ! cmp --silent "$runtime_env_src" "$runtime_env_dst" ; then
+        cp -f "$runtime_env_src" "$runtime_env_dst" 2>/dev/null || true
+      fi
+      if ! cmp --silent "$runtime_env_src" "$runtime_env_dst2" ; then
+        cp -f "$runtime_env_src" "$runtime_env_dst2" 2>/dev/null || true
+      fi
     fi
   fi
 fi
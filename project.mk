@@ -113,12 +113,16 @@ test: $(BUILDDIR)/$(BUILD_CONF_FILE)
 # Here we need to keep just some of the files under Testing/Temporary:
 #   CTestCheckpoint.txt, CTestCostData.txt and LastTestsFailed_*.log
 	$(RM) -r $(BUILDDIR)/Testing/TAG $(BUILDDIR)/Testing/20*-* $(BUILDDIR)/Testing/Temporary/LastTest_*
-	-cd $(BUILDDIR) && $(CTEST) -T test $(value MONO_ARGS) $(value ARGS)
+# Run tests in parallel (see test-jobs.py), unless a -j option is given,
+# and skip the ones that passed with the same inputs (see test-cache.py),
+# unless FORCE is set or an -E option is given
+	-cd $(BUILDDIR) && $(CTEST) -T test $(if $(filter -j% --parallel,$(ARGS)),,$$("$(DIR)test-jobs.py" $(BUILDDIR))) $$("$(DIR)test-cache.py" exclude $(if $(FORCE)$(filter -E --exclude-regex,$(ARGS)),--force) $(BUILDDIR) $(CURDIR)) $(value MONO_ARGS) $(value ARGS)
+	-@"$(DIR)test-cache.py" record $(BUILDDIR)
 	$(RM) -r $(BUILDDIR)/html
 	+@cd $(BUILDDIR) && $(CMAKE) -P $(DIR)/CTestXML2HTML.cmake
 
 install: all
-	cd $(BUILDDIR) && $(CMAKE) -P cmake_install.cmake | grep -v "^-- Up-to-date:"
+	"$(DIR)install-project.py" $(BUILDDIR) $(CURDIR)
 	test -f $(BUILDDIR)/config/$(PROJECT)-build.xenv && cp $(BUILDDIR)/config/$(PROJECT)-build.xenv $(INSTALLDIR)/$(PROJECT).xenv || true
 
 # ensure that the target are always passed to the CMake Makefile
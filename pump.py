@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""Keep a distcc pump include server warm across builds.
+
+There is one include server per stack (outputPath) and BINARY_TAG, reused
+by consecutive and concurrent builds, such that its include analysis is
+not thrown away for every project. It is replaced when the set of include
+directories of the stack changes or when a header used by the project
+being built (its sources or the InstallArea of its dependencies) was
+modified after it started, since the include server assumes that files
+do not change during its lifetime. A detached reaper stops each server
+after `distccPumpIdleTimeout` seconds without builds.
+
+Builds hold a shared lock on the `users` file of the server while they
+use it (see pump_startup in make.sh). A server in use is never stopped:
+when it needs replacing, a second server is started for the new builds
+and the old one is reaped once its builds are done.
+
+The include server statistics are printed when it stops, and on SIGUSR1
+(see SERVER_WRAPPER). At the end of each build, `pump.py snapshot` saves
+them (cumulative since the server started) to the stats of the build.
+
+Usage:
+
+    eval $(pump.py start [--debug] [--project PROJECT])
+    pump.py snapshot PID OUTPUT
+    pump.py stop
+
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import signal
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from config import read_config
+from utils import (
+    setup_logging,
+    topo_sorted,
+    walk_sources,
+    read_make_config,
+    project_dependencies,
+)
+
+HEADER_SUFFIXES = ('.h', '.hh', '.hpp', '.hxx', '.icpp', '.icc', '.inl',
+                   '.tcc')
+# Seconds between checks of the reaper
+REAP_INTERVAL = 60
+# Seconds to wait for the statistics of a server
+SNAPSHOT_TIMEOUT = 5
+# Runs include_server.py (argv[1]) such that it prints its statistics on
+# SIGUSR1, between the markers below.
+SERVER_WRAPPER = """
+import gc, os, runpy, signal, sys
+
+def dump(signum, frame):
+    import include_analyzer, statistics
+    for obj in gc.get_objects():
+        if isinstance(obj, include_analyzer.IncludeAnalyzer):
+            print('=== include server %d statistics' % os.getpid())
+            statistics.PrintStatistics(obj)
+            print('=== include server %d end of statistics' % os.getpid())
+            sys.stdout.flush()
+            break
+
+signal.signal(signal.SIGUSR1, dump)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+config = None
+log = None
+
+
+def state_dir(binary_tag):
+    return os.path.join(config['outputPath'], 'pump', binary_tag)
+
+
+def server_path(binary_tag, pid):
+    return os.path.join(state_dir(binary_tag), 'servers', f'{pid}.json')
+
+
+def current_path(binary_tag):
+    return os.path.join(state_dir(binary_tag), 'current')
+
+
+def read_server(binary_tag, pid=None):
+    """Return the server with pid (by default the current one), or None."""
+    try:
+        if pid is None:
+            with open(current_path(binary_tag)) as f:
+                pid = int(f.read())
+        with open(server_path(binary_tag, pid)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def is_alive(server):
+    try:
+        os.kill(server['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return os.path.exists(server['port'])
+
+
+def include_roots(binary_tag, project):
+    """Return the include directories of the stack and those to check.
+
+    The directories to check for modified headers are the sources of
+    `project` and the installed headers of its dependencies (all of them
+    if `project` is not known).
+
+    """
+    variables = read_make_config(
+        os.path.join(config['outputPath'], f'configuration-{binary_tag}.mk'))
+    deps = project_dependencies(variables)
+
+    def source(p):
+        return os.path.join(config['projectPath'], p)
+
+    def include(p):
+        return os.path.join(config['buildPath'], p, 'InstallArea', binary_tag,
+                            'include')
+
+    roots = [
+        path for p in sorted(deps) for path in [source(p), include(p)]
+        if os.path.isdir(path)
+    ]
+    if project not in deps:
+        return roots, roots
+    checked = [source(project)] + [
+        include(p) for p in topo_sorted(deps, [project]) if p != project
+    ]
+    return roots, [path for path in checked if path in roots]
+
+
+def server_key(install_dir, roots, debug):
+    return hashlib.sha1(
+        json.dumps([install_dir, roots, debug]).encode()).hexdigest()
+
+
+def headers_changed_since(roots, timestamp):
+    """Return the first header modified after timestamp, or None."""
+    for root in roots:
+        for dirpath, dirs, files in walk_sources(root):
+            for name in files:
+                if not name.endswith(HEADER_SUFFIXES):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.stat(path).st_mtime > timestamp:
+                        return path
+                except FileNotFoundError:
+                    pass
+    return None
+
+
+def include_server_install():
+    # use the same python as the one running the include server
+    return subprocess.run(
+        [
+            'python', '-c', 'import sysconfig; print(sysconfig.get_path('
+            f'"purelib", vars={{"base": "{config["contribPath"]}"}}))'
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True).stdout.strip() + '/include_server'
+
+
+def stop_server(binary_tag, server):
+    if is_alive(server):
+        log.debug(f"Stopping include server {server['pid']}")
+        os.kill(server['pid'], signal.SIGTERM)
+        for _ in range(50):
+            if not is_alive(server):
+                break
+            time.sleep(0.1)
+    shutil.rmtree(server['dir'], ignore_errors=True)
+    if read_server(binary_tag) == server:
+        os.remove(current_path(binary_tag))
+    try:
+        os.remove(server_path(binary_tag, server['pid']))
+    except FileNotFoundError:
+        pass
+    with open(os.path.join(state_dir(binary_tag), 'stdout'), 'a') as f:
+        f.write(f"=== include server {server['pid']} stopped\n")
+
+
+def stop_if_unused(binary_tag, server):
+    """Stop a server unless builds hold the shared lock on its users file.
+
+    Returns False if the server is in use.
+
+    """
+    try:
+        with open(server['users'], 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            stop_server(binary_tag, server)
+    except BlockingIOError:
+        return False
+    except FileNotFoundError:  # already stopped
+        stop_server(binary_tag, server)
+    return True
+
+
+def start_server(binary_tag, install_dir, key, debug):
+    path = state_dir(binary_tag)
+    started = time.time()
+    socket_dir = tempfile.mkdtemp(prefix='distcc-pump-socket-')
+    pid_file = os.path.join(path, 'pid')
+    if debug:
+        # --time = Print elapsed, user, and system time to stderr.
+        # --debug_pattern : 19 = 1 (warning) + 2 (trace 0) + 16 (data)
+        debug_args = ['--time', '--debug_pattern=19']
+    else:
+        debug_args = ['--debug_pattern=1']  # only warnings
+    cmd = [
+        'python', '-c', SERVER_WRAPPER,
+        os.path.join(install_dir, 'include_server.py'), '--port',
+        os.path.join(socket_dir, 'socket'), '--pid_file', pid_file,
+        # --statistics = Print information to stdout about include analysis
+        # (when the server exits or on SIGUSR1, see the stats script)
+        '--statistics'
+    ] + debug_args
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(
+            filter(None, [os.environ.get('PYTHONPATH'), install_dir])))
+    if debug:
+        # show the output in the terminal, stdout is read by make.sh
+        subprocess.run(cmd, env=env, stdout=sys.stderr, check=True)
+    else:
+        with open(os.path.join(path, 'stdout'), 'a') as out, \
+                open(os.path.join(path, 'stderr'), 'a') as err:
+            out.write(f"=== include server started {time.ctime()}\n")
+            out.flush()
+            subprocess.run(cmd, env=env, stdout=out, stderr=err, check=True)
+    # the include server daemonizes itself after writing the pid file
+    with open(pid_file) as f:
+        pid = int(f.read())
+    server = {
+        'pid': pid,
+        'port': os.path.join(socket_dir, 'socket'),
+        'dir': socket_dir,
+        'users': os.path.join(socket_dir, 'users'),
+        'started': started,
+        'key': key,
+    }
+    open(server['users'], 'w').close()
+    os.makedirs(os.path.dirname(server_path(binary_tag, pid)), exist_ok=True)
+    with open(server_path(binary_tag, pid), 'w') as f:
+        json.dump(server, f)
+    with open(current_path(binary_tag), 'w') as f:
+        f.write(str(pid))
+    subprocess.Popen(
+        [__file__, 'reap', str(pid)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+    return server
+
+
+def start(binary_tag, debug, project):
+    """Return a running include server, starting one if needed."""
+    path = state_dir(binary_tag)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        install_dir = include_server_install()
+        roots, checked = include_roots(binary_tag, project)
+        key = server_key(install_dir, roots, debug)
+        server = read_server(binary_tag)
+        reason = None
+        if server is None or not is_alive(server):
+            reason = 'no include server running'
+        elif debug:
+            reason = 'debugging'
+        elif server['key'] != key:
+            reason = 'include directories changed'
+        else:
+            changed = headers_changed_since(checked, server['started'])
+            if changed:
+                reason = f'{changed} changed'
+        if reason:
+            log.debug(f"Starting include server for {binary_tag}: {reason}")
+            if server is not None and not stop_if_unused(binary_tag, server):
+                # its reaper stops it once the builds using it are done
+                log.debug(f"Include server {server['pid']} is still in use")
+            server = start_server(binary_tag, install_dir, key, debug)
+        # mark the server as used (see reap)
+        os.utime(server['users'])
+    return server
+
+
+def reap(binary_tag, pid):
+    """Stop the include server pid when no build used it for some time."""
+    path = state_dir(binary_tag)
+    while True:
+        time.sleep(REAP_INTERVAL)
+        with open(os.path.join(path, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            server = read_server(binary_tag, pid)
+            if server is None:
+                return
+            try:
+                idle = time.time() - os.stat(server['users']).st_mtime
+            except FileNotFoundError:
+                idle = time.time() - server['started']
+            # a replaced server only waits for the builds still using it
+            replaced = read_server(binary_tag) != server
+            if not replaced and idle < config['distccPumpIdleTimeout']:
+                continue
+            if stop_if_unused(binary_tag, server):
+                return
+
+
+def snapshot(binary_tag, pid, output):
+    """Save the current statistics of the include server pid to output."""
+    server = read_server(binary_tag, pid)
+    if server is None or not is_alive(server):
+        return
+    stdout = os.path.join(state_dir(binary_tag), 'stdout')
+    start = os.path.getsize(stdout)
+    begin = f'=== include server {pid} statistics\n'
+    end = f'=== include server {pid} end of statistics\n'
+    os.kill(pid, signal.SIGUSR1)
+    deadline = time.time() + SNAPSHOT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        with open(stdout) as f:
+            f.seek(start)
+            text = f.read()
+        if begin in text and end in text[text.index(begin):]:
+            text = text[text.index(begin):]
+            with open(output, 'w') as f:
+                f.write(text[:text.index(end) + len(end)])
+            return
+    log.warning(f"No statistics from include server {pid}")
+
+
+def main():
+    global config, log
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('start', help='Print the environment of a server')
+    p.add_argument(
+        '--debug',
+        action='store_true',
+        help='Start a fresh server with debugging output')
+    p.add_argument(
+        '--project', help='Project to build (limits the checked headers)')
+    p = sub.add_parser('snapshot', help='Save the statistics of a server')
+    p.add_argument('pid', type=int)
+    p.add_argument('output')
+    sub.add_parser('stop', help='Stop the server')
+    p = sub.add_parser('reap', help='Stop the server when idle (internal)')
+    p.add_argument('pid', type=int)
+    args = parser.parse_args()
+
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    binary_tag = os.environ['BINARY_TAG']
+    if args.command == 'start':
+        server = start(binary_tag, args.debug, args.project)
+        print(f"export INCLUDE_SERVER_PORT='{server['port']}'")
+        print(f"export INCLUDE_SERVER_USERS='{server['users']}'")
+        print(f"export INCLUDE_SERVER_PID='{server['pid']}'")
+    elif args.command == 'stop':
+        os.makedirs(state_dir(binary_tag), exist_ok=True)
+        with open(os.path.join(state_dir(binary_tag), 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            server = read_server(binary_tag)
+            if server is not None:
+                stop_server(binary_tag, server)
+    elif args.command == 'snapshot':
+        snapshot(binary_tag, args.pid, args.output)
+    elif args.command == 'reap':
+        reap(binary_tag, args.pid)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Remove build directories and InstallAreas without waiting for it.
+
+Deleting a build directory with many thousand files takes minutes, most
+of which is spent waiting for the filesystem. Instead, each directory is
+renamed into a trash directory on the same filesystem (`.trash` under
+`buildPath` or `targetBuildPath`), which is instantaneous, and a
+detached, low priority process empties the trash in the background.
+Directories that cannot be renamed (e.g. on another filesystem) are
+deleted right away.
+
+The stale *.pyc files of the given repositories are removed in a single
+pass over their source trees.
+
+Usage (see the purge targets in the Makefile):
+
+    purge.py [--pyc REPO]... PATH...
+    purge.py --empty-trash TRASH_DIR
+
+"""
+import argparse
+import fcntl
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from config import read_config
+from utils import setup_logging, walk_sources, SOURCE_PRUNED_DIRS
+
+TRASH = '.trash'
+
+config = None
+log = None
+
+
+def trash_dir(path):
+    """Return the trash directory on the filesystem of path (or None)."""
+    path = os.path.abspath(path)
+    for key in ['targetBuildPath', 'buildPath']:
+        root = config[key] and os.path.abspath(config[key])
+        if root and path.startswith(root + os.sep):
+            return os.path.join(root, TRASH)
+    return None
+
+
+def unmount(path):
+    """Unmount a bindfs mounted build directory (see make.sh)."""
+    try:
+        subprocess.call(['fusermount', '-q', '-u', path])
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def move_to_trash(path):
+    """Rename path into the trash and return the trash directory.
+
+    Returns None if path was deleted instead.
+
+    """
+    trash = trash_dir(path)
+    if trash:
+        os.makedirs(trash, exist_ok=True)
+        entry = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                 dir=trash)
+        try:
+            os.rename(path, os.path.join(entry, 'data'))
+            log.debug(f"Moved {path} to {entry}")
+            return trash
+        except OSError as e:
+            os.rmdir(entry)
+            log.debug(f"Could not move {path} to trash ({e})")
+    log.info(f"Deleting {path}")
+    shutil.rmtree(path, ignore_errors=True)
+    return None
+
+
+def purge(path):
+    """Purge a directory and return the trash directories used."""
+    if os.path.ismount(path) and config['targetBuildPath']:
+        # the files live in targetBuildPath, move them from there
+        unmount(path)
+        rel = os.path.relpath(path, config['buildPath'])
+        return purge(os.path.join(config['targetBuildPath'], rel))
+    if not os.path.isdir(path):
+        return set()
+    trash = move_to_trash(path)
+    return {trash} if trash else set()
+
+
+def start_deleter(trash):
+    cmd = ['nice', '-n', '19']
+    if shutil.which('ionice'):
+        cmd += ['ionice', '-c', '3']
+    cmd += [os.path.abspath(__file__), '--empty-trash', trash]
+    subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+
+
+def empty_trash(trash):
+    """Delete the contents of the trash (one deleter at a time)."""
+    failed = set()
+    while True:
+        with open(os.path.join(trash, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            while True:
+                entries = set(os.listdir(trash)) - {'.lock'} - failed
+                if not entries:
+                    break
+                for name in entries:
+                    path = os.path.join(trash, name)
+                    shutil.rmtree(path, ignore_errors=True)
+                    if os.path.exists(path):
+                        failed.add(name)
+        # The deleter of a purge that moved something to the trash just
+        # before the lock was released has given up, so look again.
+        if not set(os.listdir(trash)) - {'.lock'} - failed:
+            return
+
+
+def remove_pyc(repos):
+    count = 0
+    for repo in repos:
+        # the *.pyc files are in __pycache__
+        for dirpath, dirs, files in walk_sources(
+                repo, SOURCE_PRUNED_DIRS - {'__pycache__'}):
+            for name in files:
+                if name.endswith('.pyc'):
+                    os.remove(os.path.join(dirpath, name))
+                    count += 1
+    if count:
+        log.info(f"Removed {count} *.pyc files")
+
+
+def main():
+    global config, log
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--pyc',
+        action='append',
+        default=[],
+        metavar='REPO',
+        help='Repository to remove *.pyc files from')
+    parser.add_argument(
+        '--empty-trash', metavar='TRASH_DIR', help=argparse.SUPPRESS)
+    parser.add_argument('paths', nargs='*', help='Directories to remove')
+    args = parser.parse_args()
+
+    if args.empty_trash:
+        empty_trash(args.empty_trash)
+        return 0
+
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    trashes = set()
+    for path in args.paths:
+        trashes |= purge(path)
+    for trash in trashes:
+        start_deleter(trash)
+    remove_pyc(args.pyc)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
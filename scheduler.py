@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Build stack projects concurrently, following their dependencies.
+
+The top-level Makefile is serial (.NOTPARALLEL), so independent projects
+are built one after another and the machine is idle during configure,
+link and install tails. This scheduler reads PROJECTS and <Project>_DEPS
+from the generated configuration-<tag>.mk, runs independent projects
+concurrently and splits one global job budget between their ninjas.
+
+With --tags, the projects are built for several platforms (BINARY_TAG)
+at once. The dependency graphs of all platforms are scheduled together,
+over the same job budget.
+
+"""
+import argparse
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from subprocess import Popen, PIPE, STDOUT, call
+from config import read_config, cpu_count, DIR
+from utils import (
+    setup_logging,
+    topo_sorted,
+    read_make_config,
+    project_dependencies,
+)
+
+config = None
+log = None
+_print_lock = threading.Lock()
+
+
+def downstream_counts(deps):
+    """Return the number of (transitive) dependents of each project."""
+    counts = dict.fromkeys(deps, 0)
+    for p in deps:
+        for d in set(topo_sorted(deps, [p])) - {p}:
+            counts[d] += 1
+    return counts
+
+
+def job_budget():
+    # same as the ninja default for the local machine
+    return config['buildJobs'] or (cpu_count() + 2)
+
+
+def tagged_dependencies(deps, binary_tags):
+    """Return the dependencies between (project, binary tag) pairs."""
+    return {(p, tag): [(d, tag) for d in ds]
+            for tag in binary_tags for p, ds in deps.items()}
+
+
+def label(node, multi_tag):
+    project, binary_tag = node
+    return f'{project} {binary_tag}' if multi_tag else project
+
+
+def run_project(node, target, jobs, budget, prefix):
+    """Run a make.sh target for one project in the build environment.
+
+    `node` is a (project, binary tag) pair, `jobs` its share of the job
+    `budget` and `prefix` is prepended to the output lines.
+
+    """
+    project, binary_tag = node
+    kerberos = {
+        'test': ['--check-kerberos'],
+        'clean': [],
+    }.get(target, ['--require-kerberos-distcc'])
+    cmd = [os.path.join(DIR, 'build-env')] + kerberos + [
+        os.path.join(DIR, 'make.sh'), project, target
+    ]
+    env = dict(os.environ,
+               BINARY_TAG=binary_tag,
+               BUILD_JOBS=str(jobs),
+               BUILD_JOBS_BUDGET=str(budget))
+    freshness = os.path.join(DIR, 'freshness.py')
+    if target == 'install' and call([freshness, 'check', project],
+                                    env=env) == 0:
+        return 0
+    if target == 'clean':
+        path = os.path.join(config['buildPath'], project)
+        shutil.rmtree(
+            os.path.join(path, 'InstallArea', binary_tag), ignore_errors=True)
+        if not os.path.isdir(os.path.join(path, f'build.{binary_tag}')):
+            return 0
+    log.debug(f"Starting {project}/{target} ({binary_tag}) with -j{jobs}: "
+              f"{cmd}")
+    p = Popen(cmd, stdout=PIPE, stderr=STDOUT, env=env)
+    tag = f'[{prefix}] '.encode() if prefix else b''
+    for line in p.stdout:
+        with _print_lock:
+            sys.stdout.buffer.write(tag + line)
+            sys.stdout.buffer.flush()
+    returncode = p.wait()
+    if target == 'install' and returncode == 0:
+        call([freshness, 'commit', project], env=env)
+    if target == 'clean' and returncode != 0:
+        # like fast/<Project>-clean, a failed clean does not stop the others
+        log.warning(f"Cleaning {project} ({binary_tag}) failed")
+        return 0
+    return returncode
+
+
+def schedule(deps,
+             projects,
+             target,
+             max_parallel,
+             budget,
+             deps_target='install'):
+    """Build the dependencies of `projects` and run `target` on them.
+
+    Dependencies are brought up to date with `deps_target`. A
+    project is started as soon as all its dependencies are done, with
+    the projects that unblock most downstream work started first. Each
+    started project gets an equal share of the job budget among the
+    projects that can run at that moment, but no more than what the
+    running projects left over.
+
+    The graph is made of (project, binary tag) pairs, see
+    tagged_dependencies. Returns True if everything succeeded.
+
+    """
+    if not projects:
+        return True
+    todo = topo_sorted(deps, projects)
+    priority = downstream_counts(deps)
+    multi_tag = len({tag for _, tag in deps}) > 1
+    show_prefix = max_parallel > 1 and len(todo) > 1
+    done = set()
+    failed = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while True:
+            ready = [] if failed else sorted(
+                (p for p in todo if all(d in done for d in deps.get(p, []))),
+                key=lambda p: -priority.get(p, 0))
+            n_sharing = min(max_parallel, len(running) + len(ready))
+            starting = ready[:max_parallel - len(running)]
+            free = budget - sum(jobs for _, jobs in running.values())
+            for i, p in enumerate(starting):
+                todo.remove(p)
+                jobs = max(1, min(budget // n_sharing,
+                                  free // (len(starting) - i)))
+                free -= jobs
+                p_target = target if p in projects else deps_target
+                prefix = label(p, multi_tag) if show_prefix else ''
+                future = executor.submit(run_project, p, p_target, jobs,
+                                         budget, prefix)
+                running[future] = (p, jobs)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                p, _ = running.pop(future)
+                if future.result() == 0:
+                    done.add(p)
+                else:
+                    log.error(f"{label(p, multi_tag)} failed")
+                    failed.append(p)
+    if failed and todo:
+        log.warning("Not built because of failures: " +
+                    ', '.join(label(p, multi_tag) for p in todo))
+    return not failed
+
+
+def main():
+    global config, log
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('projects', nargs='*', help='Projects to build')
+    parser.add_argument(
+        '--target',
+        default='install',
+        help='Target to make in the given projects (dependencies are '
+        'always installed)')
+    parser.add_argument(
+        '--tags',
+        help='Platforms to build for (space separated, default: BINARY_TAG)')
+    args = parser.parse_args()
+
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    binary_tags = (args.tags or os.environ['BINARY_TAG']).split()
+    # the configuration of all platforms is written by setup-make.py
+    variables = read_make_config(
+        os.path.join(config['outputPath'],
+                     f'configuration-{binary_tags[0]}.mk'))
+    deps = project_dependencies(variables)
+    unknown = set(args.projects).difference(deps)
+    if unknown:
+        log.error(f"Unknown projects: {', '.join(sorted(unknown))}")
+        return 1
+    if len(binary_tags) > 1:
+        # only one platform provides the VSCode settings (see make.sh)
+        os.environ['IDE_BINARY_TAG'] = binary_tags[0]
+    deps = tagged_dependencies(deps, binary_tags)
+    projects = [(p, tag) for tag in binary_tags for p in args.projects]
+
+    max_parallel = max(1, config['parallelProjects']) * len(binary_tags)
+    if args.target == 'test' and len(projects) > 1:
+        # The tests of a project only need its dependencies installed, so
+        # install everything first and then test all projects at once.
+        independent = {p: [] for p in projects}
+        ok = (schedule(deps, projects, 'install', max_parallel,
+                       job_budget()) and
+              schedule(independent, projects, 'test', max_parallel,
+                       cpu_count()))
+    elif args.target == 'clean':
+        # Clean the downstream projects first, which are the dependencies
+        # in the inverted graph. Cleaning is mostly waiting for the
+        # filesystem, so all independent projects are cleaned at once.
+        inv_deps = {
+            d: [p for p in sorted(deps) if d in deps[p]]
+            for d in deps
+        }
+        ok = schedule(inv_deps, projects, 'clean', len(deps), job_budget(),
+                      'clean')
+    else:
+        ok = schedule(deps, projects, args.target, max_parallel,
+                      job_budget())
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
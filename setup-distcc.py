@@ -1,17 +1,48 @@
 #!/usr/bin/env python3
 from __future__ import print_function
+import argparse
+import hashlib
+import json
 import os
 import re
 import socket
+import time
 from collections import defaultdict
-from config import read_config
-from utils import setup_logging, run, DEVNULL
+from concurrent.futures import ThreadPoolExecutor
+from config import read_config, cpu_count
+from utils import setup_logging, run, is_file_too_old, available_memory
+import tunnels
+
+# Reuse the discovered hosts for consecutive builds within this time
+CACHE_TTL = 120  # seconds
+# A host's slots are scaled by 1 / (1 + rtt / RTT_SCALE), such that
+# direct hosts (~1 ms) keep their limit and tunnelled ones get fewer jobs
+RTT_SCALE = 0.05  # seconds
+# Local memory needed by a job that is compiled remotely or locally
+REMOTE_JOB_MEMORY = 100 * 2**20
+LOCAL_JOB_MEMORY = 1500 * 2**20
+# In non-pump mode, a local preprocessor runs for about 1/CPP_SPEEDUP of
+# the time of a remote compilation
+CPP_SPEEDUP = 5
+# Minimum number of compilations for a build to update the model
+MIN_SAMPLE = 20
+# Weight of the latest build in the recorded remote ratio
+MODEL_WEIGHT = 0.5
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--pump', action='store_true', help='distcc is used in pump mode')
+parser.add_argument(
+    '--record',
+    metavar='PROJECT',
+    help='Record the remote/local ratio achieved by the build of PROJECT')
+args = parser.parse_args()
 
-SSH_CONFIG = os.path.join(os.path.dirname(__file__), 'ssh_config')
-KNOWN_HOSTS = os.path.join(os.path.dirname(__file__), '.known_hosts')
 config = read_config()
+CACHE = os.path.join(config['outputPath'], 'distcc-hosts.json')
+MODEL = os.path.join(config['outputPath'], 'stats', 'distcc-model.json')
 
-log = setup_logging(config['outputPath'])
+log = setup_logging(config['outputPath'], config)
 
 
 def parse_spec(spec):
@@ -29,7 +60,8 @@ def parse_spec(spec):
 
 def write_spec(spec):
     s = '{hostid}:{port}/{limit}'.format(**spec)
-    return s if not spec['options'] else (s + ',' + ','.join(spec['options']))
+    options = [opt for opt in spec['options'] if opt]
+    return s if not options else (s + ',' + ','.join(options))
 
 
 def is_port_open(host, port, test_distcc=False, timeout=0.2):
@@ -45,7 +77,7 @@ def is_port_open(host, port, test_distcc=False, timeout=0.2):
             if test_distcc:
                 sock.sendall(b'*')
                 return sock.recv(1) == b'*'
-    except (ConnectionError, socket.timeout):
+    except (OSError, socket.timeout):
         return False
     return True
 
@@ -56,10 +88,23 @@ def reachable(host, port=None, timeout=0.2):
     else:
         # If port is not given, check that the host is up and reachable.
         # We don't check the distcc port since it's possible that the
-        # host is up but the distcc server is down.
-        return run(
-            ['timeout', str(timeout), 'ping', '-c1', '-q', host],
-            check=False).returncode == 0
+        # host is up but the distcc server is down. Instead, try the ssh
+        # port, where a refused connection also means that the host is up.
+        try:
+            with socket.create_connection((host, 22), timeout=timeout):
+                return True
+        except ConnectionRefusedError:
+            return True
+        except (OSError, socket.timeout):
+            return False
+
+
+def handshake_time(host, port):
+    """Return the time for connecting and a handshake, or None on failure."""
+    start = time.monotonic()
+    if is_port_open(host, port, test_distcc=True):
+        return time.monotonic() - start
+    return None
 
 
 def have_valid_ticket():
@@ -71,45 +116,185 @@ def have_valid_ticket():
         return have_valid_ticket.cache
 
 
-found_hosts = {}
-proxied_hosts = defaultdict(list)
-for host in config['distccHosts']:
+def probe_host(host):
+    """Return (spec, rtt) if the host can be used or a proxy request."""
     spec = parse_spec(host['spec'])
     if 'auth' in spec['options']:
         if not have_valid_ticket():
             log.warning('No valid kerberos ticket, disabling distcc host ' +
                         host['spec'])
-            continue
+            return None
     # Check the "networkProbe" if defined, otherwise check the host directly.
     # The latter has the disadvantage that if the host down but we're on the
     # right network, we'll (unsuccessfully) try to proxy it.
     if reachable(host.get('networkProbe', spec['hostid'])):
-        # The host is directly reachable
-        # if is_port_open(spec['hostid'], spec["port"], test_distcc=True):
-        found_hosts[host['spec']] = spec['limit']
-    else:
-        # The host needs to be proxied
-        new_spec = {
-            # "localhost" has a special meaning for distcc -> use "127.0.0.1"
-            'hostid':
-            '127.0.0.1',
-            'port':
-            host['localPort'],
-            'limit':
-            spec['limit'],
-            'options': [
-                opt if opt != 'auth' else ('auth=' + spec['hostid'])
-                for opt in spec['options']
-            ]
-        }
-        if reachable(new_spec['hostid'], new_spec['port']):
-            log.debug(f"distcc server {spec['hostid']} is already proxied")
-            found_hosts[write_spec(new_spec)] = spec['limit']
+        # The host is directly reachable, exclude it if distccd is dead
+        rtt = handshake_time(spec['hostid'], spec["port"])
+        if rtt is not None:
+            return (spec, rtt)
+        log.warning(f"distcc server {host['spec']} is not responding")
+        return None
+    # The host needs to be proxied
+    new_spec = {
+        # "localhost" has a special meaning for distcc -> use "127.0.0.1"
+        'hostid':
+        '127.0.0.1',
+        'port':
+        host['localPort'],
+        'limit':
+        spec['limit'],
+        'options': [
+            opt if opt != 'auth' else ('auth=' + spec['hostid'])
+            for opt in spec['options']
+        ]
+    }
+    rtt = handshake_time(new_spec['hostid'], new_spec['port'])
+    if rtt is not None:
+        log.debug(f"distcc server {spec['hostid']} is already proxied")
+        return (new_spec, rtt)
+    # collect hosts to proxy
+    return (host['gateway'], (new_spec, host['spec'], host['localPort'],
+                              spec['hostid'], spec['port']))
+
+
+def local_capacity():
+    """Return the number of idle CPUs and the available memory in bytes."""
+    idle = max(1.0, cpu_count() - os.getloadavg()[0])
+    return idle, available_memory()
+
+
+def read_model():
+    try:
+        with open(MODEL) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def effective_limit(spec, rtt):
+    """Scale down the slots of a host with the round-trip time."""
+    return max(1, round(spec['limit'] / (1 + rtt / RTT_SCALE)))
+
+
+def job_count(remote_slots, remote_ratio, pump):
+    """Return the number of parallel jobs for the build.
+
+    Jobs that are compiled remotely are bound by the remote slots, while
+    the ones that fall back to local compilation (as measured in previous
+    builds) are bound by the idle local CPUs. Local memory and, in
+    non-pump mode, local preprocessing put an upper limit.
+
+    """
+    idle, memory = local_capacity()
+    n_jobs = (remote_slots * 5 / 4 * remote_ratio + idle *
+              (1 - remote_ratio))
+    if not pump:
+        n_jobs = min(n_jobs, config['distccLocalslotsCpp'] * CPP_SPEEDUP)
+    if memory is not None:
+        job_memory = (REMOTE_JOB_MEMORY * remote_ratio + LOCAL_JOB_MEMORY *
+                      (1 - remote_ratio))
+        n_jobs = min(n_jobs, memory / job_memory)
+    log.debug(f"distcc jobs: {n_jobs:.1f} for {remote_slots} remote slots, "
+              f"remote ratio {remote_ratio:.2f}, {idle:.1f} idle CPUs, "
+              f"{memory} bytes available")
+    return max(1, int(n_jobs))
+
+
+def record(project):
+    """Record the remote/local ratio achieved in a build.
+
+    The number of compilations are the ccache misses (each of which goes
+    through distcc) and the local ones are the fallbacks in DISTCC_LOG.
+
+    """
+    stats_dir = os.path.join(config['outputPath'], 'stats',
+                             os.environ['BINARY_TAG'])
+    try:
+        with open(os.path.join(stats_dir, f'{project}.ccache-statslog')) as f:
+            n_compiled = sum(line.strip() == 'cache_miss' for line in f)
+        with open(os.path.join(stats_dir, f'{project}.distcc-log')) as f:
+            n_local = sum(
+                bool(re.search(r'(running|retrying|compiling) locally', line))
+                for line in f)
+    except FileNotFoundError:
+        return
+    n_local = min(n_local, n_compiled)
+    with open(os.path.join(stats_dir, f'{project}.distcc-stats'), 'w') as f:
+        f.write(f"{project}: {n_compiled - n_local} compiled remotely, "
+                f"{n_local} locally\n")
+    if n_local:
+        log.warning(f"{n_local} of {n_compiled} compilations of {project} "
+                    "fell back to the local machine")
+    if n_compiled < MIN_SAMPLE:
+        return
+    model = read_model()
+    ratio = 1 - n_local / n_compiled
+    model['remoteRatio'] = round(
+        MODEL_WEIGHT * ratio +
+        (1 - MODEL_WEIGHT) * model.get('remoteRatio', ratio), 3)
+    model['builds'] = model.get('builds', 0) + 1
+    os.makedirs(os.path.dirname(MODEL), exist_ok=True)
+    tmp = f'{MODEL}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(model, f)
+    os.replace(tmp, MODEL)
+
+
+def cache_key():
+    """Key of the cached result, which depends on settings and kerberos."""
+    settings = [
+        config[k] for k in [
+            'distccHosts', 'distccPrincipal', 'distccLocalslots',
+            'distccLocalslotsCpp', 'distccRandomize'
+        ]
+    ]
+    settings += [args.pump, read_model().get('remoteRatio')]
+    uses_auth = any(
+        'auth' in parse_spec(h['spec'])['options']
+        for h in config['distccHosts'])
+    settings.append(uses_auth and have_valid_ticket())
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+
+def read_cache(key):
+    try:
+        if is_file_too_old(CACHE, CACHE_TTL):
+            return None
+        with open(CACHE) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return cache['output'] if cache.get('key') == key else None
+
+
+def write_cache(key, output):
+    tmp = f'{CACHE}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump({'key': key, 'output': output}, f)
+    os.replace(tmp, CACHE)
+
+
+if args.record:
+    record(args.record)
+    exit(0)
+
+key = cache_key()
+output = read_cache(key)
+if output is not None:
+    log.debug(f'Using cached distcc hosts from {CACHE}')
+    print(output)
+    exit(0)
+
+found_hosts = []  # (spec, rtt)
+proxied_hosts = defaultdict(list)
+with ThreadPoolExecutor(max_workers=len(config['distccHosts']) or 1) as ex:
+    for result in ex.map(probe_host, config['distccHosts']):
+        if result is None:
+            continue
+        elif isinstance(result[1], tuple):  # (gateway, forward) to proxy
+            proxied_hosts[result[0]].append(result[1])
         else:
-            # collect hosts to proxy
-            proxied_hosts[host['gateway']].append(
-                (write_spec(new_spec), host['spec'], host['localPort'],
-                 spec['hostid'], spec['port'], spec['limit']))
+            found_hosts.append(result)
 
 if proxied_hosts:
     kerberos_user = run(
@@ -117,37 +302,34 @@ if proxied_hosts:
         shell=True).stdout.strip()
 
 for gateway, hosts in proxied_hosts.items():
-    log.info('Starting ssh port forwarding for distcc hosts {}...'.format(
-        ' '.join(h[1] for h in hosts)))
-    forwards = sum((['-L', '{}:{}:{}'.format(local, host, port)]
-                    for _, _, local, host, port, _ in hosts), [])
-    cmd = [
-        'ssh', '-f', '-N', '-F', SSH_CONFIG, '-o', 'BatchMode=yes', '-o',
-        'ExitOnForwardFailure=yes', '-o', 'UserKnownHostsFile=' + KNOWN_HOSTS,
-        '-o', 'LogLevel=ERROR'
-    ] + forwards + ['{}@{}'.format(kerberos_user, gateway)]
-    code = run(
-        cmd,
-        # decouple stdout so that bash (the command substitution) does
-        # not wait forever for the stdout of this process
-        stdout=DEVNULL,
-        # do not try to capture stderr (for the log) as .communicate()
-        # seems hang in that case
-        capture_stderr=False,
-        check=False).returncode
-    if code == 0:
-        for h in hosts:
-            found_hosts[h[0]] = h[5]
-        log.info('...done.')
-    else:
-        log.error(f'Failed to forward ports via {gateway}.')
+    answering = tunnels.ensure(config, gateway, kerberos_user,
+                               [(local, host, port)
+                                for _, _, local, host, port in hosts])
+    for h in hosts:
+        if h[0]['port'] not in answering:
+            log.error(f"Failed to forward {h[1]} via {gateway}.")
+            continue
+        # the first connection through a new tunnel can be slow,
+        # so assume the worst if it does not answer in time
+        rtt = handshake_time(h[0]['hostid'], h[0]['port'])
+        found_hosts.append((h[0], 0.2 if rtt is None else rtt))
 
-n_slots = sum(found_hosts.values())
-found_hosts = sorted(found_hosts.keys())
 if not found_hosts:
     log.error("No distcc hosts found!")
     exit(1)
 
+# Order by latency (distcc prefers the hosts listed first) and give
+# fewer slots to the slow ones
+found_hosts.sort(key=lambda h: h[1])
+for spec, rtt in found_hosts:
+    log.debug(f"distcc host {spec['hostid']}:{spec['port']} "
+              f"rtt {rtt * 1000:.1f} ms")
+    spec['limit'] = effective_limit(spec, rtt)
+n_slots = sum(spec['limit'] for spec, _ in found_hosts)
+n_jobs = job_count(n_slots,
+                   read_model().get('remoteRatio', 1.0), args.pump)
+found_hosts = [write_spec(spec) for spec, _ in found_hosts]
+
 # Specify how many jobs that cannot be run remotely can be run concurrently
 # on the local machine
 n_localslots = config['distccLocalslots']
@@ -160,13 +342,16 @@ found_hosts.append('--localslots_cpp={}'.format(n_localslots_cpp))
 if config['distccRandomize']:
     found_hosts.append('--randomize')
 
-print(f"""
+output = f"""
 export DISTCC_HOSTS="{' '.join(found_hosts)}"
 export DISTCC_PRINCIPAL="{config['distccPrincipal']}"
 export DISTCC_SKIP_LOCAL_RETRY=1
 export DISTCC_IO_TIMEOUT=300
-export BUILDFLAGS="$BUILDFLAGS -j{n_slots*5//4}"
-""")
+export BUILDFLAGS="$BUILDFLAGS -j{n_jobs}"
+distcc_jobs={n_jobs}
+"""
+write_cache(key, output)
+print(output)
 # Note that the last line has no effect when BUILDFLAGS is passed to make.
 # In that case the variable goes via MAKEFLAGS.
 
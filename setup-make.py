@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Write project configuration in a makefile."""
 from __future__ import print_function
+import fcntl
 import glob
 import itertools
 import os
@@ -10,6 +11,7 @@ from subprocess import CalledProcessError
 import traceback
 import shutil
 import sys
+import time
 from concurrent.futures.thread import ThreadPoolExecutor
 from config import read_config, DIR, GITLAB_READONLY_URL, GITLAB_BASE_URLS
 from utils import (
@@ -21,11 +23,14 @@ from utils import (
     write_file_if_different,
     is_file_too_old,
     is_file_older_than_ref,
+    trace_record,
 )
 from vscode import write_vscode_settings
 
 DATA_PACKAGE_DIRS = ["DBASE", "PARAM"]
-SPECIAL_TARGETS = ["update", "report"]
+SPECIAL_TARGETS = [
+    "update", "report", "distcc-status", "ccache-budget", "profile"
+]
 MAKE_TARGET_RE = re.compile(
     r'^(?P<fast>fast/)?(?P<project>[A-Z]\w+)(/(?P<target>.*))?$')
 
@@ -532,12 +537,17 @@ def error(config_path, *args):
 def main(targets):
     global config, log
     config = read_config()
-    log = setup_logging(config['outputPath'])
+    log = setup_logging(config['outputPath'], config)
     output_path = config['outputPath']
     is_mono_build = config['monoBuild']
 
-    # save the host environment where we're executed
+    # concurrent make invocations (e.g. for different platforms) share
+    # the checkouts, so they are set up one at a time
     os.makedirs(output_path, exist_ok=True)
+    lock = open(os.path.join(output_path, 'setup-make.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    # save the host environment where we're executed
     with open(os.path.join(output_path, 'host.env'), 'w') as f:
         for name, value in sorted(os.environ.items()):
             print(name + "=" + value, file=f)
@@ -558,9 +568,16 @@ def main(targets):
                  + "or invoke with " +
                  f"`make BINARY_TAG={binary_tag_env} {' '.join(targets)}` " +
                  "to force the platform.")
-    config["binaryTag"] = binary_tag
+    # `make TAGS="a b"` builds several platforms with the same checkout
+    binary_tags = os.getenv("BINARY_TAGS", "").split()
+    tags_override = bool(binary_tags)
+    binary_tags = binary_tags or [binary_tag]
+    config["binaryTag"] = binary_tags[0]
 
-    config_path = os.path.join(output_path, f"configuration-{binary_tag}.mk")
+    config_path = os.path.join(output_path,
+                               f"configuration-{binary_tags[0]}.mk")
+    if tags_override and binary_tag_override:
+        error(config_path, "TAGS and BINARY_TAG cannot be given together")
 
     # Separate out special targets
     special_targets = [t for t in SPECIAL_TARGETS if t in targets]
@@ -580,6 +597,8 @@ def main(targets):
             update_repos()
         elif target == "report":
             report_repos()
+        elif target in ["distcc-status", "ccache-budget", "profile"]:
+            pass  # handled by the Makefile
         else:
             raise NotImplementedError(f"unknown special target {target}")
         return
@@ -594,13 +613,16 @@ def main(targets):
                 fast_checkout_projects.append(m.group('project'))
             else:
                 projects.append(m.group('project'))
-    if ('build' in targets or 'all' in targets
+    if ('build' in targets or 'all' in targets or 'test' in targets
             or not targets) and not is_mono_build:
         build_target_deps = config['defaultProjects']
         projects += build_target_deps
     else:
         build_target_deps = []
 
+    if is_mono_build and len(binary_tags) > 1:
+        error(config_path, "TAGS is not supported when monoBuild is true")
+
     if fast_checkout_projects and len(fast_checkout_projects) != len(targets):
         error(
             config_path, "fast/Project/checkout targets cannot be mixed " +
@@ -669,7 +691,6 @@ def main(targets):
         repos.sort(key=lambda x: project_order.index(x))
 
         makefile_config = [
-            "export BINARY_TAG := {}".format(config["binaryTag"]),
             "BUILD_PATH := {}".format(config["buildPath"]),
             "MONO_BUILD := " + str(int(is_mono_build)),
             "PROJECTS := " + " ".join(projects_sorted),
@@ -685,32 +706,50 @@ def main(targets):
             ]
         makefile_config += [
             "REPOS := " + " ".join(repos + dp_repos),
-            "build: " + " ".join(build_target_deps),
+            "PARALLEL_PROJECTS := {}".format(config['parallelProjects']),
+            "BUILD_PROJECTS := " + " ".join(build_target_deps),
         ]
 
     except Exception:
         traceback.print_exc()
         makefile_config = ['$(error Error occurred in checkout)']
     else:
+        # the settings are written in the background and do not need the
+        # lock (see vscode.py)
+        lock.close()
         try:
-            write_vscode_settings(repos, dp_repos, project_deps, config)
+            # `make stack.code-workspace` waits for an unconditional update
+            force = 'stack.code-workspace' in targets
+            write_vscode_settings(
+                repos,
+                dp_repos,
+                project_deps,
+                config,
+                force=force,
+                background=not force)
         except Exception:
             traceback.print_exc()
             makefile_config = [
                 '$(warning Error occurred in updating VSCode settings)'
             ]
 
-    stats_timestamp = (
-        f"{output_path}/stats/{config['binaryTag']}/start.timestamp")
-    os.makedirs(os.path.dirname(stats_timestamp), exist_ok=True)
-    with open(stats_timestamp, "w") as f:
-        pass
-
-    with open(config_path, "w") as f:
-        f.write('\n'.join(makefile_config) + '\n')
+    # the platforms differ only in BINARY_TAG
+    for tag in binary_tags:
+        stats_timestamp = f"{output_path}/stats/{tag}/start.timestamp"
+        os.makedirs(os.path.dirname(stats_timestamp), exist_ok=True)
+        with open(stats_timestamp, "w") as f:
+            pass
+        # replaced atomically as concurrent invocations may be reading it
+        path = os.path.join(output_path, f"configuration-{tag}.mk")
+        with open(path + f".{os.getpid()}", "w") as f:
+            f.write('\n'.join([f"export BINARY_TAG := {tag}"] +
+                              makefile_config) + '\n')
+        os.replace(path + f".{os.getpid()}", path)
     # Print path so that the generated file can be included in one go
     print(config_path)
 
 
 if __name__ == '__main__':
+    start = time.time()
     main(sys.argv[1:])
+    trace_record('setup-make.py', start, kind='phase', targets=sys.argv[1:])
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""Skip tests that passed before with the same inputs.
+
+The key of a test is made of
+- its definition (command and properties, from `ctest --show-only`),
+- the contents of the files it refers to (e.g. the .qmt file and the
+  options and reference files named in it),
+- the shared libraries and python modules of the project build, its
+  python sources and the InstallArea of its upstream projects,
+- the revision (and local changes) of the data packages.
+The first two are specific to each test, so that editing the options or
+the reference of one test re-runs only that test. The others are shared,
+so a rebuilt library re-runs all tests.
+
+Before running ctest, `exclude` prints a `-E` option that skips the tests
+that passed with the same key, and `record` stores the keys and the
+results (<Test> elements of Test.xml) of the tests that passed afterwards.
+The stored results of the skipped tests are merged into the Test.xml of
+the run, marked as cached, so that they show up as passed in the XML and
+HTML reports.
+
+Usage (see the test target in project.mk):
+
+    ctest $(test-cache.py exclude [--force] BUILD_DIR SOURCE_DIR) ...
+    test-cache.py record BUILD_DIR
+
+With --force, all tests are run (and the results recorded).
+
+"""
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import xml.etree.ElementTree as ET
+from config import read_config
+from utils import (
+    setup_logging,
+    topo_sorted,
+    walk_sources,
+    read_make_config,
+    project_dependencies,
+    SOURCE_PRUNED_DIRS,
+)
+
+CACHE = 'test-cache.json'
+RESULTS = 'test-cache-results.json'
+PENDING = 'test-cache-pending.json'
+SKIPPED = 'test-cache-skipped.txt'
+DATA_PACKAGE_DIRS = ['DBASE', 'PARAM']
+RUNTIME_SUFFIXES = ('.py', '.so', '.rootmap', '.components', '.confdb',
+                    '.confdb2', '.xenv')
+# Directories without test inputs, in addition to the ones of walk_sources
+PRUNED_DIRS = SOURCE_PRUNED_DIRS | {'CMakeFiles', 'Testing', 'html'}
+# Words in test files that may be paths of other input files
+FILE_RE = re.compile(
+    r'[$\w/.+-]+\.(?:py|opts|qmt|yaml|yml|json|ref|txt|xml|csv)\b')
+ROOT_RE = re.compile(r'^\$\{?(\w+)ROOT\}?/')
+
+config = None
+log = None
+
+
+def testing_path(build_dir, name):
+    return os.path.join(build_dir, 'Testing', name)
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return f'{path} {st.st_size} {st.st_mtime_ns}\n'.encode()
+
+
+def walk_stamps(top, select):
+    h = hashlib.sha1()
+    for dirpath, dirs, files in walk_sources(top, PRUNED_DIRS):
+        for name in sorted(files):
+            path = os.path.join(dirpath, name)
+            if select(path):
+                try:
+                    h.update(file_stamp(path))
+                except FileNotFoundError:
+                    pass
+    return h.hexdigest()
+
+
+def is_runtime_file(path):
+    name = os.path.basename(path)
+    return name.endswith(RUNTIME_SUFFIXES) or '.so.' in name
+
+
+def is_python_module(path):
+    # options files (e.g. in options/) are specific to tests
+    return path.endswith('.py') and f'{os.sep}python{os.sep}' in path
+
+
+def data_package_state(repo):
+    path = os.path.join(config['projectPath'], repo)
+    try:
+        head = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=path,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              check=True).stdout
+        status = subprocess.run(['git', 'status', '--porcelain'],
+                                cwd=path,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL,
+                                universal_newlines=True,
+                                check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return b''
+    state = head
+    for line in status.splitlines():
+        try:
+            state += file_stamp(os.path.join(path, line[3:]))
+        except OSError:
+            state += line.encode()
+    return state
+
+
+def shared_key(project, build_dir, source_dir, binary_tag):
+    """Return the part of the key shared by all tests of a project."""
+    h = hashlib.sha1(binary_tag.encode())
+    h.update(walk_stamps(build_dir, is_runtime_file).encode())
+    h.update(walk_stamps(source_dir, is_python_module).encode())
+    path = os.path.join(config['outputPath'], f'configuration-{binary_tag}.mk')
+    variables = read_make_config(path) if os.path.exists(path) else {}
+    deps = project_dependencies(variables)
+    if project in deps:
+        for p in topo_sorted(deps, [project]):
+            if p != project:
+                h.update(
+                    walk_stamps(
+                        os.path.join(config['buildPath'], p, 'InstallArea',
+                                     binary_tag), lambda _: True).encode())
+    for repo in variables.get('REPOS', '').split():
+        if repo.split('/')[0] in DATA_PACKAGE_DIRS:
+            h.update(repo.encode() + data_package_state(repo))
+    return h.hexdigest()
+
+
+def package_roots(source_dir):
+    """Map the $<PACKAGE>ROOT variables to the package directories."""
+    roots = {}
+    for dirpath, dirs, files in walk_sources(source_dir, PRUNED_DIRS):
+        if 'CMakeLists.txt' in files:
+            roots[os.path.basename(dirpath).upper()] = dirpath
+    return roots
+
+
+def resolve(word, base_dirs, roots):
+    m = ROOT_RE.match(word)
+    if m:
+        root = roots.get(m.group(1).upper())
+        return [os.path.join(root, word[m.end():])] if root else []
+    if os.path.isabs(word):
+        return [word]
+    return [os.path.join(d, word) for d in base_dirs]
+
+
+def input_files(test, source_dir, roots):
+    """Return the files a test refers to, following the referenced files."""
+    properties = {p['name']: p['value'] for p in test.get('properties', [])}
+    base_dirs = [properties.get('WORKING_DIRECTORY', source_dir), source_dir]
+    todo = [w for w in test.get('command', []) if os.path.isfile(w)]
+    found = set()
+    while todo:
+        path = os.path.normpath(todo.pop())
+        if path in found or not os.path.isfile(path):
+            continue
+        found.add(path)
+        if path.endswith(('.so', '.exe')) or os.path.getsize(path) > 10**6:
+            continue
+        with open(path, errors='replace') as f:
+            words = FILE_RE.findall(f.read())
+        dirs = [os.path.dirname(path)] + base_dirs
+        for word in words:
+            todo += resolve(word, dirs, roots)
+    return sorted(found)
+
+
+def test_keys(build_dir, source_dir, shared):
+    result = subprocess.run(['ctest', '--show-only=json-v1'],
+                            cwd=build_dir,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True,
+                            check=True)
+    roots = package_roots(source_dir)
+    keys = {}
+    for test in json.loads(result.stdout).get('tests', []):
+        h = hashlib.sha1(shared.encode())
+        h.update(json.dumps(test, sort_keys=True).encode())
+        for path in input_files(test, source_dir, roots):
+            with open(path, 'rb') as f:
+                h.update(path.encode() + hashlib.sha1(f.read()).digest())
+        keys[test['name']] = h.hexdigest()
+    return keys
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+
+def exclude(build_dir, source_dir, binary_tag, force):
+    project = os.path.basename(os.path.dirname(os.path.abspath(build_dir)))
+    shared = shared_key(project, build_dir, source_dir, binary_tag)
+    try:
+        keys = test_keys(build_dir, source_dir, shared)
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        log.warning(f"Not using the test cache: {e}")
+        return
+    cache = read_json(testing_path(build_dir, CACHE))
+    skipped = [] if force else sorted(
+        t for t, k in keys.items() if cache.get(t) == k)
+    write_json(testing_path(build_dir, PENDING), keys)
+    with open(testing_path(build_dir, SKIPPED), 'w') as f:
+        f.writelines(t + '\n' for t in skipped)
+    if skipped:
+        # printed for a command substitution, which does not remove quotes
+        names = '|'.join(re.escape(t).replace('\\ ', '.') for t in skipped)
+        print(f"-E ^({names})$")
+
+
+def test_xml_path(build_dir):
+    """Return the Test.xml of the last ctest run (or None)."""
+    try:
+        with open(testing_path(build_dir, 'TAG')) as f:
+            tag = f.readline().strip()
+    except FileNotFoundError:
+        return None
+    return testing_path(build_dir, os.path.join(tag, 'Test.xml'))
+
+
+def test_elements(tree):
+    """Return the <Test> elements with a result, by test name."""
+    return {
+        test.findtext('Name'): test
+        for test in tree.getroot().iter('Test') if test.get('Status')
+    }
+
+
+def mark_cached(test):
+    results = test.find('Results')
+    if results is None:
+        results = ET.SubElement(test, 'Results')
+    measurement = ET.SubElement(
+        results, 'NamedMeasurement', type='text/string', name='Test Cache')
+    ET.SubElement(measurement, 'Value').text = (
+        'Not run, passed before with the same inputs')
+
+
+def merge_cached(tree, names, stored):
+    """Add the stored results of the skipped tests to a Test.xml tree."""
+    testing = tree.getroot().find('Testing')
+    if testing is None:
+        return 0
+    test_list = testing.find('TestList')
+    # results go before <EndDateTime> and the like, after the other tests
+    index = max([i for i, e in enumerate(testing) if e.tag == 'Test'] +
+                [i for i, e in enumerate(testing) if e.tag == 'TestList'] +
+                [-1]) + 1
+    merged = 0
+    for name in names:
+        if name not in stored:
+            continue
+        test = ET.fromstring(stored[name])
+        mark_cached(test)
+        testing.insert(index + merged, test)
+        if test_list is not None:
+            ET.SubElement(test_list, 'Test').text = test.findtext('FullName')
+        merged += 1
+    return merged
+
+
+def record(build_dir):
+    keys = read_json(testing_path(build_dir, PENDING))
+    if not keys:
+        return
+    cache = read_json(testing_path(build_dir, CACHE))
+    stored = read_json(testing_path(build_dir, RESULTS))
+    xml_path = test_xml_path(build_dir)
+    try:
+        tree = ET.parse(xml_path) if xml_path else None
+    except (FileNotFoundError, ET.ParseError):
+        tree = None
+    tests = test_elements(tree) if tree else {}
+    results = {name: test.get('Status') for name, test in tests.items()}
+    for name, test in tests.items():
+        if test.get('Status') == 'passed' and name in keys:
+            cache[name] = keys[name]
+            stored[name] = ET.tostring(test, encoding='unicode')
+        else:
+            cache.pop(name, None)
+            stored.pop(name, None)
+    write_json(testing_path(build_dir, CACHE), cache)
+    write_json(testing_path(build_dir, RESULTS), stored)
+    os.remove(testing_path(build_dir, PENDING))
+    try:
+        with open(testing_path(build_dir, SKIPPED)) as f:
+            skipped = f.read().splitlines()
+    except FileNotFoundError:
+        skipped = []
+    if skipped and tree and merge_cached(tree, skipped, stored):
+        # replay the previous passes in the reports (see CTestXML2HTML)
+        tree.write(xml_path, encoding='UTF-8', xml_declaration=True)
+    if skipped:
+        passed = sum(s == 'passed' for s in results.values())
+        log.info(f"Ran {len(results)} tests ({passed} passed), skipped "
+                 f"{len(skipped)} that passed before with the same inputs "
+                 f"(listed in {testing_path(build_dir, SKIPPED)}, "
+                 "use FORCE=1 to run them)")
+
+
+def main(args):
+    global config, log
+    force = '--force' in args
+    if force:
+        args.remove('--force')
+    if not (args[:1] == ['exclude'] and len(args) == 3
+            or args[:1] == ['record'] and len(args) == 2):
+        exit(f"usage: {os.path.basename(__file__)} "
+             "exclude [--force] BUILD_DIR SOURCE_DIR | record BUILD_DIR")
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    if not config['testCache']:
+        return 0
+    if args[0] == 'exclude':
+        exclude(args[1], args[2], os.environ['BINARY_TAG'], force)
+    else:
+        record(args[1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
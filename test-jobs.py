@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Print the ctest options to run the tests of a build directory in parallel.
+
+The number of parallel tests is bound by the job share of the project
+(BUILD_JOBS, see scheduler.py) or the number of CPUs, and by the
+available memory divided by `testJobMemory`. With the cost data of
+previous runs (Testing/Temporary/CTestCostData.txt), ctest starts the
+longest tests first, and the expected duration is logged.
+
+A resource spec file with `cpus` and `memory` (in GB) is written, so that
+tests can declare their needs with the RESOURCE_GROUPS property, e.g.
+`memory:4,cpus:2`.
+
+Usage: ctest $(test-jobs.py BUILD_DIR) ...
+
+"""
+import json
+import os
+import sys
+from config import read_config, cpu_count
+from utils import setup_logging, available_memory
+
+GB = 1024**3
+
+config = None
+log = None
+
+
+def read_costs(build_dir):
+    """Return the average duration of each test in previous runs."""
+    costs = {}
+    path = os.path.join(build_dir, 'Testing', 'Temporary',
+                        'CTestCostData.txt')
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith('---'):  # followed by the failed tests
+                    break
+                fields = line.split()
+                if len(fields) == 3:
+                    costs[fields[0]] = float(fields[2])
+    except (FileNotFoundError, ValueError):
+        pass
+    return costs
+
+
+def expected_duration(costs, jobs):
+    """Return the duration of running the tests longest first."""
+    workers = [0.0] * jobs
+    for cost in sorted(costs.values(), reverse=True):
+        workers[workers.index(min(workers))] += cost
+    return max(workers)
+
+
+def write_resource_spec(path, cpus, memory_gb):
+    spec = {
+        'version': {
+            'major': 1,
+            'minor': 0
+        },
+        'local': [{
+            'cpus': [{
+                'id': '0',
+                'slots': cpus
+            }],
+            'memory': [{
+                'id': '0',
+                'slots': memory_gb
+            }],
+        }],
+    }
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(spec, f)
+
+
+def main(args):
+    global config, log
+    if len(args) != 1:
+        exit(f"usage: {os.path.basename(__file__)} BUILD_DIR")
+    build_dir, = args
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+
+    cpus = int(os.environ.get('BUILD_JOBS') or 0) or cpu_count()
+    cpus = min(cpus, cpu_count())
+    jobs = cpus
+    memory = available_memory()
+    memory_gb = int(memory / GB) if memory else cpus * config['testJobMemory']
+    if config['testJobMemory']:
+        jobs = min(jobs, int(memory_gb / config['testJobMemory']))
+    jobs = max(1, jobs)
+
+    costs = read_costs(build_dir)
+    if costs:
+        log.info(f"Running {len(costs)} tests with -j{jobs}, expected to "
+                 f"take {expected_duration(costs, jobs) / 60:.0f} min")
+    spec = os.path.join(build_dir, 'Testing', 'resource-spec.json')
+    write_resource_spec(spec, cpus, max(1, memory_gb))
+    print(f"-j{jobs} --test-load {cpu_count()} --resource-spec-file {spec}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
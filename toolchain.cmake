@@ -60,6 +60,22 @@ if(NOT DEFINED _LBSTACK_PROCESSED)
       set(CMAKE_JOB_POOL_LINK local_pool)
       set(GENREFLEX_JOB_POOL local_pool)
     endif()
+    # Memory hungry jobs get their own pools, sized by their peak memory
+    # (see job-pools.py, which also adjusts the depths between builds)
+    if (DEFINED ENV{LINK_POOL_DEPTH} AND DEFINED ENV{GENREFLEX_POOL_DEPTH})
+      set_property(GLOBAL APPEND PROPERTY JOB_POOLS
+        link_pool=$ENV{LINK_POOL_DEPTH} genreflex_pool=$ENV{GENREFLEX_POOL_DEPTH})
+      set(CMAKE_JOB_POOL_LINK link_pool)
+      set(GENREFLEX_JOB_POOL genreflex_pool)
+      # Record the peak memory of links, dictionaries and the functor cache
+      set(_job_launcher "${CMAKE_CURRENT_LIST_DIR}/job-launcher.sh")
+      set(CMAKE_C_LINKER_LAUNCHER "${_job_launcher};link" CACHE STRING "lb-stack-setup override")
+      set(CMAKE_CXX_LINKER_LAUNCHER "${_job_launcher};link" CACHE STRING "lb-stack-setup override")
+      get_property(_rule_launch_custom GLOBAL PROPERTY RULE_LAUNCH_CUSTOM)
+      if(NOT _rule_launch_custom)
+        set_property(GLOBAL PROPERTY RULE_LAUNCH_CUSTOM "${_job_launcher} custom")
+      endif()
+    endif()
   endif()
   set(_LBSTACK_PROCESSED TRUE)
 endif()
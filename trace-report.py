@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Report where the time of the last make invocations went.
+
+The timing records are read from trace.jsonl in the output directory.
+They are written by utils.run_nb for every command run from python, and
+by trace_record (helpers.sh) for the phases of make.sh and build-env. The
+records of one top-level make share the LBSTACK_INVOCATION set in the
+Makefile.
+
+Phases are nested (e.g. "make.sh install" includes "project.mk install")
+and concurrent projects overlap, so the totals do not add up to the wall
+time.
+
+Usage: make profile [N=5]
+
+"""
+import argparse
+import json
+import os
+import sys
+from collections import defaultdict
+from config import read_config
+from utils import TRACE_FILENAME
+
+config = None
+
+
+def read_records(path):
+    records = []
+    for p in [path + '.1', path]:
+        try:
+            with open(p) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        pass  # partially written
+        except FileNotFoundError:
+            pass
+    for r in records:
+        if 'duration' not in r:
+            r['duration'] = r['end'] - r['start']
+    return records
+
+
+def breakdown(records, kind, limit):
+    stats = defaultdict(lambda: [0, 0.0, 0.0, 0])
+    for r in records:
+        if r.get('kind') == kind:
+            s = stats[r['name']]
+            s[0] += 1
+            s[1] += r['duration']
+            s[2] = max(s[2], r['duration'])
+            s[3] += bool(r.get('returncode'))
+    lines = []
+    for name, (count, total, longest, failed) in sorted(
+            stats.items(), key=lambda x: -x[1][1])[:limit]:
+        lines.append(f"    {name[:40]:<40} {count:>5} {total:>9.2f} "
+                     f"{longest:>8.2f}" + (f"  ({failed} failed)"
+                                           if failed else ""))
+    if lines:
+        lines.insert(
+            0, f"    {kind + 's':<40} {'count':>5} {'total s':>9} "
+            f"{'max s':>8}")
+    return lines
+
+
+def report(records, limit):
+    lines = []
+    for kind in ['phase', 'command']:
+        lines += breakdown(records, kind, limit)
+    return '\n'.join(lines)
+
+
+def main():
+    global config
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n',
+        '--last',
+        type=int,
+        default=5,
+        help='Number of make invocations to report')
+    parser.add_argument(
+        '--top',
+        type=int,
+        default=10,
+        help='Number of phases and commands to list for each invocation')
+    args = parser.parse_args()
+    config = read_config()
+
+    invocations = defaultdict(list)
+    for r in read_records(os.path.join(config['outputPath'],
+                                       TRACE_FILENAME)):
+        if r.get('invocation'):
+            invocations[r['invocation']].append(r)
+    if not invocations:
+        print("No timing records found, run make first")
+        return 1
+
+    last = sorted(
+        invocations, key=lambda i: min(r['start']
+                                       for r in invocations[i]))[-args.last:]
+    for i in last:
+        records = invocations[i]
+        start = min(r['start'] for r in records)
+        end = max(r['start'] + r['duration'] for r in records)
+        setup = [r for r in records if r['name'] == 'setup-make.py']
+        targets = ' '.join(
+            min(setup, key=lambda r: r['start'])['targets']) if setup else ''
+        print(f"make {targets} ({i}): {end - start:.1f} s")
+        print(report(records, args.top))
+    if len(last) > 1:
+        print(f"All {len(last)} invocations:")
+        print(report(sum((invocations[i] for i in last), []), 2 * args.top))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
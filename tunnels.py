@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""Supervise the ssh tunnels to distcc hosts that are not directly reachable.
+
+One supervisor process per gateway owns an `ssh -N -L ...` process with
+the forwards of all hosts behind that gateway. It regularly checks the
+forwards with a distcc handshake, restarts ssh when it dies or stops
+answering, and exits when no connection went through the tunnel for
+`distccTunnelIdleTimeout` seconds. The state of the supervisors is kept
+in outputPath/tunnels, such that concurrent builds share them.
+
+Set LBSTACK_TUNNEL_COMMAND to replace `ssh ... user@gateway` with another
+forwarder taking the same -L options (e.g. a local TCP forwarder).
+
+Usage:
+
+    tunnels.py status        # or `make distcc-status`
+    tunnels.py stop [GATEWAY ...]
+
+"""
+import argparse
+import fcntl
+import json
+import os
+import shlex
+import signal
+import socket
+import sys
+import time
+from contextlib import contextmanager
+from subprocess import Popen, DEVNULL, STDOUT
+from config import read_config, DIR
+from utils import setup_logging
+
+SSH_CONFIG = os.path.join(DIR, 'ssh_config')
+KNOWN_HOSTS = os.path.join(DIR, '.known_hosts')
+# Seconds between health checks of the forwards
+CHECK_INTERVAL = 5
+# Consecutive failed health checks after which ssh is restarted
+MAX_FAILURES = 3
+# Seconds to wait for a new tunnel to answer
+START_TIMEOUT = 15
+
+log = None
+
+
+def state_dir(config):
+    return os.path.join(config['outputPath'], 'tunnels')
+
+
+def state_path(config, gateway):
+    return os.path.join(state_dir(config), f'{gateway}.json')
+
+
+def read_state(config, gateway):
+    try:
+        with open(state_path(config, gateway)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_state(config, gateway, state):
+    path = state_path(config, gateway)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def gateway_lock(config, gateway):
+    os.makedirs(state_dir(config), exist_ok=True)
+    with open(state_path(config, gateway) + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def handshake(port, timeout=1.0):
+    """Check that a distcc server answers on a local port."""
+    try:
+        with socket.create_connection(('127.0.0.1', port),
+                                      timeout=timeout) as sock:
+            sock.sendall(b'*')
+            return sock.recv(1) == b'*'
+    except (OSError, socket.timeout):
+        return False
+
+
+def active_connections(ports):
+    """Count the established connections to the local ends of forwards."""
+    n = 0
+    for path in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            port = int(fields[1].rsplit(':', 1)[1], 16)
+            if fields[3] == '01' and port in ports:  # 01 = ESTABLISHED
+                n += 1
+    return n
+
+
+def tunnel_command(gateway, user, forwards):
+    options = sum((['-L', f'{local}:{host}:{port}']
+                   for local, host, port in forwards), [])
+    override = os.environ.get('LBSTACK_TUNNEL_COMMAND')
+    if override:
+        return shlex.split(override) + options
+    return [
+        'ssh', '-N', '-F', SSH_CONFIG, '-o', 'BatchMode=yes', '-o',
+        'ExitOnForwardFailure=yes', '-o', 'UserKnownHostsFile=' + KNOWN_HOSTS,
+        '-o', 'LogLevel=ERROR', '-o', 'ServerAliveInterval=15', '-o',
+        'ServerAliveCountMax=2'
+    ] + options + [f'{user}@{gateway}']
+
+
+def supervise(config, gateway, user, forwards):
+    """Keep a tunnel through gateway up until it is idle."""
+    ports = {local for local, _, _ in forwards}
+    restart = False
+
+    def request_restart(signum, frame):
+        nonlocal restart
+        restart = True
+
+    signal.signal(signal.SIGUSR1, request_restart)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    state = {
+        'pid': os.getpid(),
+        'forwards': forwards,
+        'user': user,
+        'started': time.time(),
+        'restarts': 0,
+        'healthy': None,
+        'lastActive': time.time(),
+    }
+    proc = None
+    failures = 0
+    backoff = 1
+    logfile = open(state_path(config, gateway)[:-len('.json')] + '.log', 'a')
+    try:
+        while True:
+            if restart and proc is not None:
+                log.info(f"Restart of the tunnel via {gateway} requested")
+                proc.terminate()
+                proc.wait()
+                proc = None
+            restart = False
+            if proc is None or proc.poll() is not None:
+                if proc is not None:
+                    log.warning(f"Tunnel via {gateway} exited with "
+                                f"{proc.returncode}, restarting")
+                    time.sleep(backoff)
+                    backoff = min(60, backoff * 2)
+                    state['restarts'] += 1
+                proc = Popen(
+                    tunnel_command(gateway, user, forwards),
+                    stdin=DEVNULL,
+                    stdout=logfile,
+                    stderr=STDOUT)
+                state['sshPid'] = proc.pid
+                failures = 0
+            time.sleep(CHECK_INTERVAL)
+            now = time.time()
+            if active_connections(ports):
+                state['lastActive'] = now
+            state['healthy'] = any(handshake(port) for port in ports)
+            state['checked'] = now
+            if state['healthy']:
+                failures = 0
+                backoff = 1
+            else:
+                failures += 1
+                if failures >= MAX_FAILURES:
+                    log.warning(f"Tunnel via {gateway} is not answering, "
+                                "restarting")
+                    restart = True
+            write_state(config, gateway, state)
+            if now - state['lastActive'] > config['distccTunnelIdleTimeout']:
+                log.debug(f"Tunnel via {gateway} is idle, stopping")
+                break
+    finally:
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+        # do not take the lock here as stop() may hold it
+        current = read_state(config, gateway)
+        if current and current['pid'] == os.getpid():
+            os.remove(state_path(config, gateway))
+
+
+def stop(config, gateway, wait=True):
+    state = read_state(config, gateway)
+    if state and is_alive(state['pid']):
+        os.kill(state['pid'], signal.SIGTERM)
+        while wait and is_alive(state['pid']):
+            time.sleep(0.05)
+
+
+def ensure(config, gateway, user, forwards):
+    """Make sure that a supervised tunnel via gateway provides forwards.
+
+    `forwards` is a list of (local port, host, port). A running
+    supervisor is reused if it covers them, otherwise it is replaced by
+    one with all forwards. Returns the local ports that answer.
+
+    """
+    global log
+    log = setup_logging(config['outputPath'], config)
+    forwards = [list(f) for f in forwards]
+    with gateway_lock(config, gateway):
+        state = read_state(config, gateway)
+        running = state is not None and is_alive(state['pid'])
+        if running and all(f in state['forwards'] for f in forwards):
+            if not any(handshake(f[0]) for f in forwards):
+                os.kill(state['pid'], signal.SIGUSR1)
+        else:
+            if running:
+                forwards += [
+                    f for f in state['forwards'] if f not in forwards
+                ]
+                stop(config, gateway)
+            log.info(f"Starting tunnel via {gateway} for " +
+                     ' '.join(f'{host}:{port}' for _, host, port in forwards))
+            cmd = [__file__, 'supervise', gateway, '--user', user]
+            for local, host, port in forwards:
+                cmd += ['--forward', f'{local}:{host}:{port}']
+            p = Popen(
+                cmd,
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+                start_new_session=True)
+            write_state(config, gateway, {'pid': p.pid, 'forwards': forwards})
+
+    ports = [f[0] for f in forwards]
+    deadline = time.time() + START_TIMEOUT
+    while True:
+        answering = [port for port in ports if handshake(port)]
+        if answering or time.time() > deadline:
+            return answering
+        time.sleep(0.2)
+
+
+def list_gateways(config):
+    try:
+        names = sorted(os.listdir(state_dir(config)))
+    except FileNotFoundError:
+        names = []
+    return [n[:-len('.json')] for n in names if n.endswith('.json')]
+
+
+def status(config):
+    gateways = list_gateways(config)
+    if not gateways:
+        print("No distcc tunnels")
+    now = time.time()
+    for gateway in gateways:
+        state = read_state(config, gateway)
+        if not state:
+            continue
+        alive = is_alive(state['pid'])
+        print(f"{gateway}: supervisor {state['pid']} "
+              f"{'running' if alive else 'dead'}"
+              f", up {now - state.get('started', now):.0f} s"
+              f", {state.get('restarts', 0)} restarts"
+              f", idle {now - state.get('lastActive', now):.0f} s")
+        for local, host, port in state['forwards']:
+            ok = alive and handshake(local)
+            print(f"    127.0.0.1:{local} -> {host}:{port} "
+                  f"{'OK' if ok else 'FAIL'}, "
+                  f"{active_connections({local})} connections")
+
+
+def main():
+    global log
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status', help='Show the tunnels and their health')
+    p = sub.add_parser('stop', help='Stop tunnels')
+    p.add_argument('gateways', nargs='*', help='Gateways (default all)')
+    p = sub.add_parser('supervise', help='Run a supervisor (internal)')
+    p.add_argument('gateway')
+    p.add_argument('--user', required=True)
+    p.add_argument('--forward', action='append', default=[])
+    args = parser.parse_args()
+
+    config = read_config()
+    log = setup_logging(config['outputPath'], config)
+    if args.command == 'status':
+        status(config)
+    elif args.command == 'stop':
+        for gateway in args.gateways or list_gateways(config):
+            stop(config, gateway)
+    elif args.command == 'supervise':
+        forwards = []
+        for f in args.forward:
+            local, host, port = f.split(':')
+            forwards.append([int(local), host, int(port)])
+        supervise(config, args.gateway, args.user, forwards)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
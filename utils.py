@@ -1,8 +1,19 @@
+import fcntl
+import glob
+import gzip
+import itertools
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import re
+import shutil
+import sys
 import textwrap
 import time
 from collections import namedtuple
+from datetime import datetime
 from subprocess import Popen, PIPE, CalledProcessError
 try:
     from subprocess import DEVNULL
@@ -11,6 +22,20 @@ except ImportError:
 
 _log = None
 _log_filename = None
+_log_output_limit = 0
+_spill_counter = itertools.count()
+SPILL_DIR = 'log-spill'
+# Log settings used by setup_logging when not in the config it is given
+# (same as in default-config.json)
+LOG_DEFAULTS = {
+    'logMaxSize': 50,
+    'logMaxAge': 7,
+    'logBackupCount': 5,
+    'logOutputLimit': 100000,
+}
+# Timing records of commands and phases (see trace-report.py)
+TRACE_FILENAME = 'trace.jsonl'
+TRACE_MAX_SIZE = 20 * 1024**2
 
 
 class ConsoleFormatter(logging.Formatter):
@@ -37,8 +62,146 @@ class ConsoleFormatter(logging.Formatter):
         return formatter.format(record)
 
 
-def setup_logging(directory):
-    global _log, _log_filename
+def _log_start_time(filename):
+    """Return the time of the first record in a log file."""
+    try:
+        with open(filename) as f:
+            ts = f.read(19)
+        return time.mktime(time.strptime(ts, '%Y-%m-%dT%H:%M:%S'))
+    except (OSError, ValueError):
+        return time.time()
+
+
+def rotate_log(filename, backup_count, inode=None):
+    """Rotate a log file that is shared with other processes.
+
+    The file is renamed with a timestamp suffix and older backups are
+    compressed. The last backup is not compressed yet, since processes
+    that opened the file before may still be appending to it. Backups
+    beyond `backup_count` and the command outputs spilled while they were
+    written are removed. If `inode` is given, the file is only rotated if
+    it was not replaced in the meantime.
+
+    """
+    with open(filename + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if inode is not None and os.stat(filename).st_ino != inode:
+                return  # rotated by another process
+        except FileNotFoundError:
+            return
+        backups = sorted(
+            glob.glob(filename + '.2*[0-9]') +
+            glob.glob(filename + '.2*.gz'))
+        for path in backups:
+            if not path.endswith('.gz'):
+                with open(path, 'rb') as f_in, \
+                        gzip.open(path + '.gz', 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(path)
+        suffix = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        os.replace(filename, f'{filename}.{suffix}')
+        backups = sorted(
+            p if p.endswith('.gz') else p + '.gz' for p in backups)
+        removed = backups[:max(0, len(backups) - backup_count + 1)]
+        if removed:
+            last_removed = os.path.getmtime(removed[-1])
+            for path in removed:
+                os.remove(path)
+            spill_dir = os.path.join(os.path.dirname(filename), SPILL_DIR)
+            for path in glob.glob(os.path.join(spill_dir, '*')):
+                if os.path.getmtime(path) <= last_removed:
+                    os.remove(path)
+
+
+def rotate_log_if_needed(directory):
+    """Rotate the log in `directory` if too large or too old."""
+    from config import read_config
+    config = read_config()
+    filename = os.path.join(directory, 'log')
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return
+    if (st.st_size > config['logMaxSize'] * 1024**2
+            or time.time() - _log_start_time(filename) >
+            config['logMaxAge'] * 86400):
+        rotate_log(filename, config['logBackupCount'], st.st_ino)
+
+
+class RotatingLogHandler(logging.FileHandler):
+    """File handler for a log that many processes append to.
+
+    The file is rotated when larger than `max_bytes` or older than
+    `max_age` seconds (see rotate_log). A process that finds the file
+    rotated by another one reopens it.
+
+    """
+
+    def __init__(self, filename, max_bytes, max_age, backup_count):
+        super().__init__(filename, mode='a')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self._start = _log_start_time(filename)
+
+    def _reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+        self._start = _log_start_time(self.baseFilename)
+
+    def emit(self, record):
+        try:
+            try:
+                st = os.stat(self.baseFilename)
+            except FileNotFoundError:
+                self._reopen()
+            else:
+                if st.st_ino != os.fstat(self.stream.fileno()).st_ino:
+                    self._reopen()
+                elif (st.st_size > self.max_bytes
+                      or time.time() - self._start > self.max_age):
+                    rotate_log(self.baseFilename, self.backup_count,
+                               st.st_ino)
+                    self._reopen()
+        except OSError:
+            pass
+        super().emit(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that writes out the queued records when closed."""
+
+    def __init__(self, handler):
+        super().__init__(queue.SimpleQueue())
+        self._handler = handler
+        self._start_listener()
+        # threads do not survive fork, e.g. in vscode.py
+        os.register_at_fork(after_in_child=self._start_listener)
+
+    def _start_listener(self):
+        self.queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(
+            self.queue, self._handler)
+        self._listener.start()
+        self._listening = True
+
+    def close(self):
+        # called by logging.shutdown() at exit
+        if self._listening:
+            self._listening = False
+            self._listener.stop()
+        super().close()
+
+
+def setup_logging(directory, config=None):
+    """Log to the console and asynchronously to `directory`/log.
+
+    The rotation of the log and the limit of the command outputs are
+    taken from the caller's `config` (see LOG_DEFAULTS).
+
+    """
+    global _log, _log_filename, _log_output_limit
     log_filename = os.path.join(directory, 'log')
     if _log is not None:
         if log_filename != _log_filename:
@@ -48,21 +211,107 @@ def setup_logging(directory):
     _log_filename = log_filename
     os.makedirs(directory, exist_ok=True)
 
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format=
-        '%(asctime)s.%(msecs)03d %(name)-15s %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%dT%H:%M:%S',
-        filename=log_filename,
-        filemode='a')
+    settings = {k: (config or {}).get(k, v) for k, v in LOG_DEFAULTS.items()}
+    _log_output_limit = settings['logOutputLimit']
+    file_handler = RotatingLogHandler(
+        log_filename,
+        max_bytes=settings['logMaxSize'] * 1024**2,
+        max_age=settings['logMaxAge'] * 86400,
+        backup_count=settings['logBackupCount'])
+    file_handler.setFormatter(
+        logging.Formatter(
+            '%(asctime)s.%(msecs)03d %(name)-15s %(levelname)-8s %(message)s',
+            datefmt='%Y-%m-%dT%H:%M:%S'))
+    root = logging.getLogger('')
+    root.setLevel(logging.DEBUG)
+    # formatting and writing is done by a background thread
+    root.addHandler(_QueueHandler(file_handler))
     console = logging.StreamHandler()
     console.setLevel(logging.INFO)
     console.setFormatter(ConsoleFormatter())
-    logging.getLogger('').addHandler(console)
+    root.addHandler(console)
     _log = logging.getLogger(os.path.basename(__file__))
     return _log
 
 
+def _truncate_output(text, name):
+    """Return text, cut to the configured limit, spilling it to a file."""
+    if text is None or not 0 < _log_output_limit < len(text):
+        return text
+    spill_dir = os.path.join(os.path.dirname(_log_filename), SPILL_DIR)
+    os.makedirs(spill_dir, exist_ok=True)
+    spill = os.path.join(
+        spill_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-"
+        f"{next(_spill_counter)}-{name}.txt")
+    with open(spill, 'w') as f:
+        f.write(text)
+    half = _log_output_limit // 2
+    return (f"{text[:half]}\n... [{len(text) - 2 * half} characters cut, "
+            f"see {spill}] ...\n{text[-half:]}")
+
+
+def rotate_trace(path):
+    """Move a full trace file to its backup, once for all processes.
+
+    Like in rotate_log, the rotation is done under a lock, and only if
+    the file is still full, such that a process that saw the full file
+    does not move the new trace file of another one over the backup.
+
+    """
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.getsize(path) > TRACE_MAX_SIZE:
+                os.replace(path, path + '.1')
+        except FileNotFoundError:
+            pass
+
+
+def trace_record(name, start, returncode=None, **fields):
+    """Append a timing record to the trace file in the output directory.
+
+    The record of a command or phase that started at `start` (as given
+    by time.time()) and ends now.
+
+    """
+    if _log_filename is None:
+        return
+    record = dict(
+        fields,
+        name=name,
+        start=start,
+        duration=time.time() - start,
+        returncode=returncode,
+        invocation=os.environ.get('LBSTACK_INVOCATION'),
+        pid=os.getpid(),
+        script=os.path.basename(sys.argv[0]),
+    )
+    path = os.path.join(os.path.dirname(_log_filename), TRACE_FILENAME)
+    try:
+        if os.path.getsize(path) > TRACE_MAX_SIZE:
+            rotate_trace(path)
+    except FileNotFoundError:
+        pass
+    # a single write of a line is atomic for files opened in append mode
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def command_name(args, shell=False):
+    """Return a short name for a command, e.g. "git fetch"."""
+    words = args.split() if shell else [str(a) for a in args]
+    if not words:
+        return ''
+    name = os.path.basename(words[0])
+    if name == 'git':
+        subcommands = [w for w in words[1:] if not w.startswith('-')]
+        # skip the argument of -C
+        if '-C' in words[1:2] and subcommands:
+            subcommands = subcommands[1:]
+        name += ' ' + subcommands[0] if subcommands else ''
+    return name
+
+
 def run_nb(args,
            shell=False,
            capture_stdout=True,
@@ -72,6 +321,7 @@ def run_nb(args,
            log=True,
            **kwargs):
     """Non-blocking run() that returns a blocking function."""
+    start = time.time()
     p = Popen(
         args,
         shell=shell,
@@ -89,14 +339,23 @@ def run_nb(args,
         stdout, stderr = [
             b if b is None else b.decode('utf-8') for b in p.communicate()
         ]
+        trace_record(
+            command_name(args, shell),
+            start,
+            p.returncode,
+            kind='command',
+            cmd=args if shell else [str(a) for a in args],
+            cwd=os.path.abspath(cwd or '.'))
         level = logging.ERROR if check and p.returncode else logging.DEBUG
         if log or level == logging.ERROR:
             msg = (f"Result of command{in_dir_msg}: {cmd_msg}\n" +
                    f"\tretcode: {p.returncode}")
             if stderr is not None:
-                msg += "\n\tstderr: " + stderr.rstrip("\n")
+                msg += "\n\tstderr: " + _truncate_output(
+                    stderr.rstrip("\n"), 'stderr')
             if stdout is not None:
-                msg += "\n\tstdout: " + stdout.rstrip("\n")
+                msg += "\n\tstdout: " + _truncate_output(
+                    stdout.rstrip("\n"), 'stdout')
             _log.log(level, msg)
         if check and p.returncode != 0:
             raise CalledProcessError(p.returncode, args)
@@ -147,6 +406,25 @@ def write_file_if_different(path, contents, executable=False, backup=None):
     return old_contents
 
 
+# Directories of a source tree without sources (build.* directories are
+# skipped as well)
+SOURCE_PRUNED_DIRS = frozenset(['.git', 'InstallArea', '__pycache__', '.vscode'])
+
+
+def walk_sources(top, pruned=SOURCE_PRUNED_DIRS):
+    """Walk a source tree like os.walk, skipping generated directories.
+
+    The directories named in `pruned` and the build directories are not
+    entered. The subdirectories are visited in sorted order and can be
+    pruned further by the caller, as with os.walk.
+
+    """
+    for dirpath, dirs, files in os.walk(top):
+        dirs[:] = sorted(d for d in dirs
+                         if d not in pruned and not d.startswith('build.'))
+        yield dirpath, dirs, files
+
+
 def topo_sorted(deps, start=None):
     """Toplogically sort dependent projects.
 
@@ -163,6 +441,36 @@ def topo_sorted(deps, start=None):
     return walk(start or deps, set())
 
 
+def read_make_config(path):
+    """Return the variables assigned with := in a generated .mk file."""
+    variables = {}
+    with open(path) as f:
+        for line in f:
+            m = re.match(
+                r'^(export\s+)?(?P<name>\w+)\s*:=\s*(?P<value>.*)$', line)
+            if m:
+                variables[m.group('name')] = m.group('value').strip()
+    return variables
+
+
+def project_dependencies(variables):
+    """Return the project dependencies from a configuration-<tag>.mk."""
+    return {
+        p: variables.get(f'{p}_DEPS', '').split()
+        for p in variables.get('ALL_PROJECTS', '').split()
+    }
+
+
+def available_memory():
+    """Return the available memory in bytes (or None if unknown)."""
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f)
+        return int(meminfo['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
 def add_file_to_git_exclude(root_dir, filename):
     """Adds `filename` as exclude pattern to `root_dir`/.git/info/exclude
 
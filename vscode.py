@@ -1,33 +1,44 @@
 #!/usr/bin/env python3
+import fcntl
+import functools
+import hashlib
 import json
+import logging
 import os
 import re
 import shutil
+import sys
 from collections import OrderedDict
-from utils import setup_logging, write_file_if_different, topo_sorted, add_file_to_git_exclude
+from concurrent.futures.thread import ThreadPoolExecutor
+from utils import setup_logging, write_file_if_different, topo_sorted, add_file_to_git_exclude, walk_sources
 from config import rinterp
 
 DIR = os.path.dirname(__file__)
 TEMPLATE = os.path.join(DIR, 'template.code-workspace')
 WORKSPACE = 'stack.code-workspace'
+STAMP = 'vscode-settings.stamp'
+INDEX_SIZE = 'vscode-index-size.json'
+# Directories with generated files next to the sources
+GENERATED_DIRS = ['build.*', 'InstallArea']
 log = None
 
 
-def read_runtime_env(filename):
+@functools.lru_cache()
+def _read_runtime_env(filename, mtime_ns):
     with open(filename) as f:
-        return dict(tuple(line.rstrip('\n').split('=', 1)) for line in f)
+        return dict(
+            line.rstrip('\n').split('=', 1) for line in f if '=' in line)
+
+
+def read_runtime_env(filename):
+    return _read_runtime_env(filename, os.stat(filename).st_mtime_ns)
 
 
 def get_runtime_var(filename, name, default=None):
     try:
-        # return read_runtime_env(filename)[name]
-        with open(filename) as f:
-            for line in f:
-                if line.startswith(name + '='):
-                    return line[len(name) + 1:].rstrip('\n')
+        return read_runtime_env(filename).get(name, default)
     except FileNotFoundError:
-        pass
-    return default
+        return default
 
 
 def create_clang_format(config, path='.clang-format'):
@@ -125,6 +136,85 @@ def get_toolchain(config):
     return toolchain
 
 
+def _is_within(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def excluded_roots(config):
+    """Return the directories of build products, caches and outputs."""
+    roots = {}
+    for key in ['buildPath', 'targetBuildPath', 'ccachePath', 'outputPath']:
+        path = config[key]
+        if not path:
+            continue
+        if '$' in path:
+            # e.g. the per platform ccache directories
+            path = os.path.dirname(path[:path.index('$')] + 'x')
+        roots[key] = os.path.abspath(os.path.expanduser(path))
+    return roots
+
+
+def exclusion_patterns(config, folders, projects):
+    """Return absolute and folder relative globs of generated files.
+
+    `folders` are the absolute paths of the workspace folders. Directories
+    that contain a workspace folder (e.g. buildPath when the build
+    directories are next to the sources) are never excluded as a whole.
+
+    """
+    absolute = []
+    relative = ['**/__pycache__', '**/*.pyc']
+    for key, root in excluded_roots(config).items():
+        if any(_is_within(f, root) for f in folders):
+            if key in ['buildPath', 'targetBuildPath']:
+                # Project/build.<tag> and Project/InstallArea (also bindfs
+                # mount points of targetBuildPath)
+                for name in projects:
+                    absolute += [
+                        os.path.join(root, name, d, '**')
+                        for d in GENERATED_DIRS
+                    ]
+                relative += ['**/' + d for d in GENERATED_DIRS]
+            continue
+        absolute.append(os.path.join(root, '**'))
+        relative += [
+            os.path.relpath(root, f) for f in folders if _is_within(root, f)
+        ]
+    return absolute, relative
+
+
+def index_size_estimates(folders, absolute):
+    """Return the number and size of files VSCode would index per folder."""
+    excluded = [p[:-len('/**')] for p in absolute if '*' not in p[:-3]]
+    estimates = {}
+    for folder in folders:
+        files = size = 0
+        for dirpath, dirs, filenames in walk_sources(folder):
+            dirs[:] = [
+                d for d in dirs if os.path.join(dirpath, d) not in excluded
+            ]
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_size
+                    files += 1
+                except FileNotFoundError:
+                    pass
+        estimates[folder] = {'files': files, 'bytes': size}
+    return estimates
+
+
+def write_index_size_estimates(folders, absolute, config):
+    estimates = index_size_estimates(folders, absolute)
+    path = os.path.join(config['outputPath'], INDEX_SIZE)
+    with open(path, 'w') as f:
+        json.dump(estimates, f, indent=4, sort_keys=True)
+    largest = sorted(estimates, key=lambda f: -estimates[f]['files'])[:3]
+    log.debug('Largest workspace folders to index: ' + ', '.join(
+        f"{os.path.basename(f)} ({estimates[f]['files']} files, "
+        f"{estimates[f]['bytes'] / 1024**2:.0f} MB)" for f in largest) +
+              f' (see {path})')
+
+
 def write_workspace_settings(repos,
                              config,
                              toolchain,
@@ -153,6 +243,21 @@ def write_workspace_settings(repos,
         folder_paths[path] = None  # None is a dummy value
     settings['folders'] = list({'path': p} for p in folder_paths)
 
+    # keep the file watchers, search and indexers out of generated files
+    folders = [
+        os.path.abspath(os.path.join(stack_dir, p)) for p in folder_paths
+    ]
+    projects = [os.path.basename(p) for p in repos]
+    if config['monoBuild']:
+        projects.append('mono')
+    absolute, relative = exclusion_patterns(config, folders, projects)
+    for key, patterns in [('files.watcherExclude', absolute + relative),
+                          ('search.exclude', relative)]:
+        settings['settings'].setdefault(key, {}).update(
+            dict.fromkeys(patterns, True))
+    settings['settings'].setdefault('python.analysis.exclude', []).extend(
+        absolute + relative)
+
     settings['settings'].update(config['vscodeWorkspaceSettings'])
 
     if config["monoBuild"]:
@@ -189,6 +294,56 @@ def write_workspace_settings(repos,
                 tofile=output_path,
             )))
 
+    write_index_size_estimates(folders, absolute, config)
+
+
+def create_compile_commands(path):
+    if not os.path.isfile(path):
+        # Create a file with an empty list so VSCode does not
+        # complain about projects that are not yet built and
+        # projects that have no compilation targets (e.g. MooreAnalysis).
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write("[]")
+        # NOTE: we don't want to set it to "" (the default), as the
+        # extension nags us with "info" messages:
+        # > would like to configure IntelliSense for the 'Xyz' folder.
+        # where no meaningful choice can exist...
+
+
+def settings_digest(repos, dp_repos, project_repos, project_deps, config):
+    """Return a digest of everything the generated settings depend on."""
+    h = hashlib.sha1(
+        json.dumps([os.getcwd(), repos, dp_repos, project_deps, config],
+                   sort_keys=True,
+                   default=sorted).encode())
+    for path in [TEMPLATE, __file__]:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    for project, repo_path in sorted(project_repos.items()):
+        project_path = os.path.join(config['outputPath'], project)
+        for path in [
+                os.path.join(project_path, 'runtime.env'),
+                os.path.join(project_path, 'compile_commands.json')
+        ]:
+            try:
+                st = os.stat(path)
+                h.update(f'{path} {st.st_size} {st.st_mtime_ns}\n'.encode())
+            except FileNotFoundError:
+                pass
+    return h.hexdigest()
+
+
+def outputs_exist(project_repos):
+    outputs = [WORKSPACE]
+    for repo_path in project_repos.values():
+        outputs += [
+            os.path.join(repo_path, '.clangd'),
+            os.path.join(repo_path, '.vscode', 'settings.json'),
+            os.path.join(repo_path, '.vscode', 'c_cpp_properties.json'),
+        ]
+    return all(os.path.exists(p) for p in outputs)
+
 
 def write_project_settings(repos, project_deps, config, toolchain):
     # Get only the CMake project repos
@@ -225,14 +380,16 @@ def write_project_settings(repos, project_deps, config, toolchain):
 
     log.debug('Potentially updating project settings for {}'.format(
         ', '.join(project_repos)))
-    for project, repo_path in project_repos.items():
+
+    def write(project, repo_path):
         add_file_to_git_exclude(repo_path, ".vscode")
         # tell clangd where to find compile_commands.json
         # this is useful for people that don't use vscode
-        with open(os.path.join(repo_path, ".clangd"), 'w') as f:
-            f.write("# DO NOT EDIT (auto generated file)\n"
-                    "CompileFlags:\n"
-                    f"\tCompilationDatabase: {config['outputPath']}/{project}")
+        write_file_if_different(
+            os.path.join(repo_path, ".clangd"),
+            "# DO NOT EDIT (auto generated file)\n"
+            "CompileFlags:\n"
+            f"\tCompilationDatabase: {config['outputPath']}/{project}")
         add_file_to_git_exclude(repo_path, ".clangd")
 
         project_path = os.path.join(config['outputPath'], project)
@@ -249,18 +406,6 @@ def write_project_settings(repos, project_deps, config, toolchain):
             "../{}/**".format(project_repos[d]) for d in reversed(deps)
             if d in project_repos
         ]
-        if not os.path.isfile(compile_commands):
-            # Create a file with an empty list so VSCode does not
-            # complain about projects that are not yet built and
-            # projects that have no compilation targets (e.g. MooreAnalysis).
-            os.makedirs(os.path.dirname(compile_commands), exist_ok=True)
-            with open(compile_commands, 'w') as f:
-                f.write("[]")
-            # NOTE: we don't want to set it to "" (the default), as the
-            # extension nags us with "info" messages:
-            # > would like to configure IntelliSense for the 'Xyz' folder.
-            # where no meaningful choice can exist...
-
         os.makedirs(os.path.join(repo_path, '.vscode'), exist_ok=True)
         update_json(
             os.path.join(repo_path, '.vscode', 'settings.json'),
@@ -288,17 +433,81 @@ def write_project_settings(repos, project_deps, config, toolchain):
                 }]
             }))
 
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for future in [
+                executor.submit(write, p, path)
+                for p, path in project_repos.items()
+        ]:
+            future.result()
 
-def write_vscode_settings(repos, dp_repos, project_deps, config):
-    global log
-    log = setup_logging(config['outputPath'])
-
-    toolchain = get_toolchain(config)
 
-    write_workspace_settings(repos + dp_repos, config, toolchain)
-    if not config["monoBuild"]:
-        write_project_settings(repos, project_deps, config, toolchain)
+def _write_vscode_settings(repos, dp_repos, project_deps, config, force):
+    if config["monoBuild"]:
+        project_repos, project_deps = {"mono": "mono"}, {"mono": []}
     else:
-        write_project_settings(["mono"], {"mono": []}, config, toolchain)
-    create_clang_format(config)
-    create_python_tool_wrappers(config)
+        project_repos = {
+            os.path.basename(path): path
+            for path in repos if os.path.basename(path) in project_deps
+        }
+    stamp_path = os.path.join(config['outputPath'], STAMP)
+    with open(stamp_path, 'a+') as f:
+        # concurrent make invocations update the settings one at a time
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        # placeholders for projects not built yet (the digest depends on them)
+        for project in project_repos:
+            create_compile_commands(
+                os.path.join(config['outputPath'], project,
+                             'compile_commands.json'))
+        digest = settings_digest(repos, dp_repos, project_repos, project_deps,
+                                 config)
+        if (not force and f.read() == digest
+                and outputs_exist(project_repos)):
+            log.debug('VSCode settings are up to date')
+            return
+
+        toolchain = get_toolchain(config)
+        write_workspace_settings(repos + dp_repos, config, toolchain)
+        write_project_settings(
+            list(project_repos.values()), project_deps, config, toolchain)
+        create_clang_format(config)
+        create_python_tool_wrappers(config)
+        f.seek(0)
+        f.truncate()
+        f.write(digest)
+
+
+def write_vscode_settings(repos,
+                          dp_repos,
+                          project_deps,
+                          config,
+                          force=False,
+                          background=False):
+    """Update the VSCode and clangd settings if their inputs changed.
+
+    With background=True, the settings are written by a forked process,
+    so that make does not wait for them.
+
+    """
+    global log
+    log = setup_logging(config['outputPath'], config)
+
+    if not background:
+        _write_vscode_settings(repos, dp_repos, project_deps, config, force)
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() != 0:
+        return
+    try:
+        os.setsid()
+        # make waits for the standard output to be closed
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(devnull, 1)
+        _write_vscode_settings(repos, dp_repos, project_deps, config, force)
+    except Exception:
+        log.exception('Error occurred in updating VSCode settings')
+    finally:
+        logging.shutdown()
+        os._exit(0)